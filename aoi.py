@@ -0,0 +1,66 @@
+import numpy as np
+import shapely
+import shapely.affinity
+import shapely.geometry
+from rasterio import features
+from rasterio.transform import Affine
+from rasterio.warp import transform_geom
+
+
+def load_aoi(aoi, dst_crs, aoi_crs=None):
+    # AOI as one shapely geometry in dst_crs. aoi is a vector file path (e.g. GPKG,
+    # all features are merged) or a shapely geometry in aoi_crs (default dst_crs)
+    if isinstance(aoi, str):
+        # Imported here, geopandas is slow to import and only needed for files
+        import geopandas as gpd
+        gdf = gpd.read_file(aoi)
+        aoi_crs = gdf.crs
+        geometry = shapely.union_all(gdf.geometry.values)
+    else:
+        geometry = aoi
+
+    if aoi_crs is not None and dst_crs is not None and aoi_crs != dst_crs:
+        geometry = shapely.geometry.shape(transform_geom(aoi_crs, dst_crs, shapely.geometry.mapping(geometry)))
+    return geometry
+
+
+def to_pixels(geometry, transform):
+    # Geometry in (col, row) pixel coordinates of a raster with the transform
+    a, b, c, d, e, f = (~transform)[:6]
+    return shapely.affinity.affine_transform(geometry, [a, b, d, e, c, f])
+
+
+def prune_sample_grid(sample_grid, geometry_px):
+    # Blocks whose written area intersects the pixel space AOI. The regular
+    # block lattice is the spatial index: the AOI is rasterized with one cell
+    # per block (all touched cells), so the cost does not grow with the AOI detail
+    rows = -(-(sample_grid.raster_h) // sample_grid.sample_h) + 1
+    cols = -(-(sample_grid.raster_w) // sample_grid.sample_w) + 1
+    cells = features.rasterize([geometry_px], out_shape=(rows, cols),
+                               transform=Affine.scale(sample_grid.sample_w, sample_grid.sample_h),
+                               all_touched=True, dtype=np.uint8)
+
+    y0, _, x0, _ = sample_grid.extents().T
+    keep = cells[y0 // sample_grid.sample_h, x0 // sample_grid.sample_w] > 0
+    return sample_grid.take(keep)
+
+
+class AoiClipper:
+    # Zeroes the parts of written blocks outside the pixel space AOI
+
+    def __init__(self, geometry_px):
+        self.geometry = geometry_px
+        shapely.prepare(self.geometry)
+
+    def clip(self, b, raster):
+        height, width = raster.shape[:2]
+        box = shapely.geometry.box(b['x'], b['y'], b['x'] + width, b['y'] + height)
+        if self.geometry.contains(box):
+            return raster
+        inside = features.rasterize([self.geometry], out_shape=(height, width),
+                                    transform=Affine.translation(b['x'], b['y']),
+                                    dtype=np.uint8)
+        return raster * inside.astype(raster.dtype)
+
+    def wrap(self, write):
+        return lambda b, raster: write(b, self.clip(b, raster))
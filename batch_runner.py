@@ -0,0 +1,108 @@
+import argparse
+import glob
+import json
+import os
+
+import polygonization
+import sliding_window
+
+
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+
+def list_scenes(sources):
+    # sources: a path or a list of paths, each one a GeoTIFF, a directory,
+    # a glob pattern or a manifest (.txt with a path per line, or a .json list)
+    if isinstance(sources, (str, os.PathLike)):
+        sources = [sources]
+
+    scenes = []
+    for source in map(str, sources):
+        if glob.has_magic(source):
+            scenes += sorted(p for p in glob.glob(source, recursive=True)
+                             if p.lower().endswith(TIFF_EXTENSIONS))
+        elif os.path.isdir(source):
+            scenes += sorted(os.path.join(source, p) for p in os.listdir(source)
+                             if p.lower().endswith(TIFF_EXTENSIONS))
+        elif source.lower().endswith(('.txt', '.json')):
+            with open(source) as f:
+                if source.lower().endswith('.json'):
+                    paths = json.load(f)
+                else:
+                    paths = [line.strip() for line in f]
+                    paths = [p for p in paths if p and not p.startswith('#')]
+            # Relative paths are relative to the manifest
+            base = os.path.dirname(source)
+            scenes += [os.path.join(base, p) for p in paths]
+        else:
+            scenes.append(source)
+    return scenes
+
+
+def output_paths(scenes, out_dir, extension):
+    paths = [os.path.join(out_dir, os.path.splitext(os.path.basename(p))[0] + extension) for p in scenes]
+    if len(set(paths)) != len(paths):
+        raise ValueError('Scenes with the same file name would overwrite each other outputs')
+    return paths
+
+
+def run_batch(func, sources, out_dir, to_gpkg=False, simplify_tolerance=None, skip_existing=False, **kwargs):
+    # Segments all scenes with one func (one loaded model), writes out_dir/<name>.tif
+    # and with to_gpkg=True also out_dir/<name>.gpkg. Returns the segmented (scene, output) pairs
+    scenes = list_scenes(sources)
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = list(zip(scenes, output_paths(scenes, out_dir, '.tif')))
+    gpkgs = dict(zip(scenes, output_paths(scenes, out_dir, '.gpkg')))
+
+    # Polygonization of a scene runs while the next scenes are segmented
+    on_scene_done = None
+    if to_gpkg:
+        on_scene_done = lambda src_fp, dst_fp: polygonization.tiff_to_gpkg(dst_fp, gpkgs[src_fp], simplify_tolerance)
+
+    if skip_existing:
+        # Scenes with an output but no GPKG are only polygonized
+        if to_gpkg:
+            for src_fp, dst_fp in jobs:
+                if os.path.exists(dst_fp) and not os.path.exists(gpkgs[src_fp]):
+                    on_scene_done(src_fp, dst_fp)
+        jobs = [(src_fp, dst_fp) for src_fp, dst_fp in jobs if not os.path.exists(dst_fp)]
+
+    sliding_window.tiffs_to_tiffs(jobs, func, on_scene_done=on_scene_done, **kwargs)
+    return jobs
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Segment a batch of GeoTIFFs with one loaded Segment Anything model')
+    parser.add_argument('sources', nargs='+', help='GeoTIFFs, directories, glob patterns or .txt / .json manifests')
+    parser.add_argument('--out-dir', required=True)
+    parser.add_argument('--checkpoint', default='sam_vit_h_4b8939.pth')
+    parser.add_argument('--model-type', default='vit_h')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--sam-kwargs', type=json.loads, default=None, help='JSON object of SamAutomaticMaskGenerator arguments')
+    parser.add_argument('--sample-size', type=int, nargs=2, default=(512, 512))
+    parser.add_argument('--bound', type=int, default=128)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--prefetch', type=int, default=2)
+    parser.add_argument('--skip-invalid', action='store_true')
+    parser.add_argument('--gpkg', action='store_true', help='Also polygonize every output to GPKG')
+    parser.add_argument('--simplify-tolerance', type=float, default=None)
+    parser.add_argument('--skip-existing', action='store_true')
+    args = parser.parse_args(args)
+
+    # Imported here, so listing and argument errors do not wait for torch
+    from sameo import SamEO
+    sam_eo = SamEO(checkpoint=args.checkpoint, model_type=args.model_type,
+                   device=args.device, sam_kwargs=args.sam_kwargs)
+    sam_eo.batch_tiff_to_tiff(args.sources, args.out_dir,
+                              to_gpkg=args.gpkg,
+                              simplify_tolerance=args.simplify_tolerance,
+                              skip_existing=args.skip_existing,
+                              sample_size=tuple(args.sample_size),
+                              bound=args.bound,
+                              batch_size=args.batch_size,
+                              prefetch=args.prefetch,
+                              skip_invalid=args.skip_invalid)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+
+import cv2
+import numpy as np
+import rasterio
+import torch
+from rasterio.transform import from_origin
+
+import metrics
+import polygonization
+import sliding_window
+from sameo import SamEO
+from segment_anything.build_sam import _build_sam
+from segment_anything.utils import amg
+
+
+# Randomly initialised encoders, small enough for CPU only machines. The mask
+# decoder of _build_sam always has the full size
+MODELS = {
+    'tiny': dict(encoder_embed_dim=32, encoder_depth=2, encoder_num_heads=2, encoder_global_attn_indexes=[1]),
+    'small': dict(encoder_embed_dim=96, encoder_depth=4, encoder_num_heads=4, encoder_global_attn_indexes=[1, 3]),
+}
+
+# Synthetic scenes: size (h, w), internal tiling (None for strips), compression, nodata fraction
+SCENES = {
+    'quick': [
+        dict(name='tiled_deflate', size=(512, 512), block=256, compress='deflate', nodata_fraction=0.0),
+        dict(name='striped_raw', size=(384, 640), block=None, compress=None, nodata_fraction=0.0),
+        dict(name='tiled_lzw_nodata', size=(512, 768), block=256, compress='lzw', nodata_fraction=0.5),
+    ],
+    'full': [
+        dict(name='tiled_deflate', size=(2048, 2048), block=512, compress='deflate', nodata_fraction=0.0),
+        dict(name='tiled_lzw', size=(2048, 2048), block=256, compress='lzw', nodata_fraction=0.0),
+        dict(name='striped_raw', size=(1536, 2560), block=None, compress=None, nodata_fraction=0.0),
+        dict(name='tiled_deflate_nodata', size=(2048, 3072), block=512, compress='deflate', nodata_fraction=0.5),
+        dict(name='tiled_jpeg_nodata', size=(2048, 2048), block=256, compress='jpeg', nodata_fraction=0.25),
+    ],
+}
+
+# RLE utility micro benchmarks: mask size (h, w) and number of masks per tile
+RLE_CASES = {
+    'quick': [dict(name='rle_512x128', size=(512, 512), masks=128)],
+    'full': [
+        dict(name='rle_768x256', size=(768, 768), masks=256),
+        dict(name='rle_1024x512', size=(1024, 1024), masks=512),
+    ],
+}
+
+
+def make_synthetic_tiff(fp, size, block=256, compress=None, nodata_fraction=0.0, seed=0):
+    # Textured background with random rectangles and ellipses, the right
+    # nodata_fraction of the columns is nodata (0)
+    h, w = size
+    rng = np.random.default_rng(seed)
+    image = (rng.normal(100, 20, (h, w, 3))).clip(0, 255).astype(np.uint8)
+    for _ in range(h * w // 4096):
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        x, y = int(rng.integers(0, w)), int(rng.integers(0, h))
+        sx, sy = int(rng.integers(4, 48)), int(rng.integers(4, 48))
+        if rng.random() < 0.5:
+            cv2.rectangle(image, (x, y), (x + sx, y + sy), color, -1)
+        else:
+            cv2.ellipse(image, (x, y), (sx, sy), float(rng.integers(0, 180)), 0, 360, color, -1)
+    image[image == 0] = 1
+    if nodata_fraction > 0:
+        image[:, w - int(w * nodata_fraction):] = 0
+
+    profile = dict(driver='GTiff', height=h, width=w, count=3, dtype='uint8',
+                   crs='EPSG:32633', transform=from_origin(500000, 6000000, 0.5, 0.5), nodata=0)
+    if block is not None:
+        profile.update(tiled=True, blockxsize=block, blockysize=block)
+    if compress is not None:
+        profile['compress'] = compress
+    with rasterio.open(fp, 'w', **profile) as dst:
+        dst.write(np.transpose(image, (2, 0, 1)))
+
+
+def make_synthetic_masks(size, masks, seed=0):
+    # One to three random ellipses per mask, some cut by the tile edges
+    h, w = size
+    rng = np.random.default_rng(seed)
+    out = np.zeros((masks, h, w), dtype=np.uint8)
+    for mask in out:
+        for _ in range(int(rng.integers(1, 4))):
+            axes = (int(rng.integers(2, w // 4)), int(rng.integers(2, h // 4)))
+            cv2.ellipse(mask, (int(rng.integers(0, w)), int(rng.integers(0, h))), axes,
+                        float(rng.integers(0, 180)), 0, 360, 1, -1)
+    return out > 0
+
+
+def run_rle_suite(suite='quick'):
+    results = []
+    for case in RLE_CASES[suite]:
+        masks = torch.as_tensor(make_synthetic_masks(case['size'], case['masks']))
+        rles = amg.mask_to_rle_pytorch(masks)
+        funcs = {
+            'rle_encode': lambda: amg.mask_to_rle_pytorch(masks),
+            'rle_decode': lambda: amg.rles_to_masks(rles),
+            'rle_area': lambda: amg.areas_from_rles(rles),
+        }
+        for name, func in funcs.items():
+            result = measure(func, 0)
+            results.append(dict(case, case=name, **result))
+            print(f"{case['name']:<24}{name:<28}{result['seconds']:>8.2f} s")
+    return results
+
+
+def bench_sam_eo(model, points_per_side=4, defaults=False, seed=0):
+    # Without IoU and stability filtering every mask reaches the compositing,
+    # with defaults=True the generator defaults apply (but points_per_side)
+    torch.manual_seed(seed)
+    sam_kwargs = dict(points_per_side=points_per_side)
+    if not defaults:
+        sam_kwargs.update(points_per_batch=points_per_side ** 2,
+                          pred_iou_thresh=0.0,
+                          stability_score_thresh=0.0)
+    return SamEO(checkpoint=None, model_type=partial(_build_sam, **MODELS[model]), sam_kwargs=sam_kwargs)
+
+
+class TileCounter:
+    # Sliding window callable counting the tiles that reach the model
+
+    def __init__(self, func):
+        self.func = func
+        self.tiles = 0
+
+    def __call__(self, image, valid_mask=None):
+        self.tiles += 1
+        return self.func(image, valid_mask)
+
+    def batch_call(self, images, valid_masks=None):
+        self.tiles += len(images)
+        return self.func.batch_call(images, valid_masks)
+
+
+def measure(func, tiles, counter=None):
+    # Wall time, tiles per second and per-stage summary of one call. With a
+    # TileCounter the tiles that reached the model are reported too, tiles
+    # skipped as invalid are in tiles but not in inferred_tiles
+    if counter is not None:
+        counter.tiles = 0
+    with metrics.collect(verbose=False) as collected:
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+    inferred = counter.tiles if counter is not None else tiles
+    return {'seconds': seconds,
+            'tiles': tiles,
+            'tiles_per_s': tiles / seconds if seconds > 0 else 0.0,
+            'inferred_tiles': inferred,
+            'inferred_tiles_per_s': inferred / seconds if seconds > 0 else 0.0,
+            'stages': collected.summary()}
+
+
+def run_suite(suite='quick', model='tiny', sample_size=(256, 256), bound=32, batch_size=1,
+              points_per_side=4, work_dir=None):
+    counter = TileCounter(bench_sam_eo(model, points_per_side))
+    defaults_counter = TileCounter(bench_sam_eo(model, points_per_side, defaults=True))
+    results = []
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        for scene in SCENES[suite]:
+            src_fp = os.path.join(tmp, scene['name'] + '.tif')
+            dst_fp = os.path.join(tmp, scene['name'] + '_out.tif')
+            defaults_fp = os.path.join(tmp, scene['name'] + '_defaults.tif')
+            make_synthetic_tiff(src_fp, scene['size'], scene['block'], scene['compress'], scene['nodata_fraction'])
+            sh, sw = sample_size
+            tiles = len(sliding_window.calculate_sample_grid(*scene['size'], sh, sw, bound))
+
+            # The sliding window of SamEO.tiff_to_tiff, with the model tile count
+            cases = {
+                'tiff_to_tiff': (counter, lambda: sliding_window.tiff_to_tiff(
+                    src_fp, dst_fp, counter, sample_size=sample_size, bound=bound, batch_size=batch_size)),
+                'tiff_to_tiff_skip_invalid': (counter, lambda: sliding_window.tiff_to_tiff(
+                    src_fp, dst_fp, counter, sample_size=sample_size, bound=bound, batch_size=batch_size,
+                    skip_invalid=True)),
+                'tiff_to_gpkg': (None, lambda: polygonization.tiff_to_gpkg(dst_fp, os.path.join(tmp, scene['name'] + '.gpkg'))),
+                # Two-phase decoding, IoU and stability filtering of the generator defaults
+                'tiff_to_tiff_defaults': (defaults_counter, lambda: sliding_window.tiff_to_tiff(
+                    src_fp, defaults_fp, defaults_counter, sample_size=sample_size, bound=bound,
+                    batch_size=batch_size)),
+            }
+            if scene['nodata_fraction'] == 0:
+                del cases['tiff_to_tiff_skip_invalid']
+
+            # image_to_image on the same pixels, without GeoTIFF I/O
+            with rasterio.open(src_fp) as src:
+                image = np.transpose(src.read(), (1, 2, 0))[..., ::-1].copy()
+            cases['image_to_image'] = (counter, lambda: sliding_window.image_to_image(
+                image, counter, sample_size=sample_size, bound=bound, batch_size=batch_size))
+
+            for case, (case_counter, func) in cases.items():
+                result = measure(func, tiles if case != 'tiff_to_gpkg' else 0, case_counter)
+                results.append(dict(scene, case=case, **result))
+                print(f"{scene['name']:<24}{case:<28}{result['seconds']:>8.2f} s{result['tiles_per_s']:>8.2f} tiles/s"
+                      f"{result['inferred_tiles_per_s']:>8.2f} inferred tiles/s")
+
+    results += run_rle_suite(suite)
+    return {'environment': environment(),
+            'settings': dict(suite=suite, model=model, sample_size=list(sample_size), bound=bound,
+                             batch_size=batch_size, points_per_side=points_per_side),
+            'results': results}
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit,
+            'python': sys.version.split()[0],
+            'torch': torch.__version__,
+            'torch_threads': torch.get_num_threads(),
+            'rasterio': rasterio.__version__,
+            'gdal': rasterio.__gdal_version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare(baseline, current, tolerance=0.2):
+    # Cases whose wall time grew by more than tolerance over the baseline
+    old = {(r['name'], r['case']): r['seconds'] for r in baseline['results']}
+    regressions = []
+    for r in current['results']:
+        key = (r['name'], r['case'])
+        if key in old and old[key] > 0:
+            ratio = r['seconds'] / old[key]
+            print(f'{key[0]:<24}{key[1]:<28}{ratio:>8.2f}x')
+            if ratio > 1 + tolerance:
+                regressions.append((key, ratio))
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmarks on synthetic GeoTIFFs with randomly initialised tiny SAM models')
+    parser.add_argument('--suite', choices=sorted(SCENES), default='quick')
+    parser.add_argument('--model', choices=sorted(MODELS), default='tiny')
+    parser.add_argument('--sample-size', type=int, nargs=2, default=(256, 256))
+    parser.add_argument('--bound', type=int, default=32)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--points-per-side', type=int, default=4)
+    parser.add_argument('--output', default='benchmark_results.json', help='Results JSON, usable as a baseline')
+    parser.add_argument('--baseline', default=None, help='Results JSON to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown over the baseline')
+    args = parser.parse_args(args)
+
+    current = run_suite(args.suite, args.model, tuple(args.sample_size), args.bound,
+                        args.batch_size, args.points_per_side)
+    with open(args.output, 'w') as f:
+        json.dump(current, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), current, args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} cases slower than the baseline by more than {args.tolerance:.0%}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+
+import numpy as np
+from rasterio.windows import Window
+
+
+class CachedBlockReader:
+    # Reads sample windows from whole internal blocks of the source instead of
+    # boundless (VRT backed) windows. Decoded blocks are kept in a small LRU
+    # cache, so the overlap between neighbouring windows is decoded only once,
+    # and the area outside the raster is padded in NumPy.
+
+    def __init__(self, src, window_height=768, cache_blocks=None, min_block_side=256):
+        self.src = src
+
+        # Tiny blocks (e.g. one-row strips) are grouped, keeping the alignment
+        bh, bw = src.block_shapes[0]
+        self.block_h = bh * max(1, min_block_side // bh)
+        self.block_w = bw * max(1, min_block_side // bw)
+
+        # By default hold a full row of windows worth of blocks
+        if cache_blocks is None:
+            blocks_per_row = -(-src.width // self.block_w)
+            cache_blocks = blocks_per_row * (-(-window_height // self.block_h) + 1)
+        self.cache_blocks = max(1, cache_blocks)
+        self.cache = OrderedDict()
+
+    def read(self, x, y, height, width, nodata=0, **kwargs):
+        src = self.src
+        out = np.full((src.count, height, width), nodata, dtype=src.dtypes[0])
+
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, src.width), min(y + height, src.height)
+        if x1 <= x0 or y1 <= y0:
+            return out
+
+        for row in range(y0 // self.block_h, (y1 - 1) // self.block_h + 1):
+            for col in range(x0 // self.block_w, (x1 - 1) // self.block_w + 1):
+                block = self.block(row, col)
+                by, bx = row * self.block_h, col * self.block_w
+
+                # Intersection of the block and the requested window
+                iy0, iy1 = max(y0, by), min(y1, by + block.shape[1])
+                ix0, ix1 = max(x0, bx), min(x1, bx + block.shape[2])
+                out[:, iy0 - y:iy1 - y, ix0 - x:ix1 - x] = block[:, iy0 - by:iy1 - by, ix0 - bx:ix1 - bx]
+        return out
+
+    def block(self, row, col):
+        key = (row, col)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        src = self.src
+        by, bx = row * self.block_h, col * self.block_w
+        window = Window(bx, by, min(self.block_w, src.width - bx), min(self.block_h, src.height - by))
+        block = src.read(window=window)
+
+        self.cache[key] = block
+        if len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last=False)
+        return block
+
+
+def order_sample_grid(sample_grid, block_h, block_w):
+    # Row-major over the source blocks where the windows start, so windows
+    # sharing blocks are read one after another
+    if hasattr(sample_grid, 'origins'):
+        y, x = np.maximum(sample_grid.origins, 0).T
+        return sample_grid.take(np.lexsort((x // block_w, y // block_h)))
+    return sorted(sample_grid, key=lambda b: (max(b['y'], 0) // block_h, max(b['x'], 0) // block_w))
@@ -0,0 +1,135 @@
+import os
+
+import cv2
+import numpy as np
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+from block_reader import order_sample_grid
+from mosaic import open_source
+from sliding_window import (BufferedBlockWriter, block_readers, calculate_sample_grid, chw_to_hwc,
+                            process_sample_grid, write_array_block, write_cog)
+
+
+def read_decimated_block(src, factor, x, y, height, width, nodata=0, **kwargs):
+    # read_block of the raster downsampled by factor, GDAL takes the data from
+    # overviews when the source has them
+    out = np.full((src.count, height, width), nodata, dtype=src.dtypes[0])
+    ch, cw = -(-src.height // factor), -(-src.width // factor)
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + width, cw), min(y + height, ch)
+    if x1 <= x0 or y1 <= y0:
+        return out
+
+    window = Window(x0 * factor, y0 * factor,
+                    min(x1 * factor, src.width) - x0 * factor,
+                    min(y1 * factor, src.height) - y0 * factor)
+    out[:, y0 - y:y1 - y, x0 - x:x1 - x] = src.read(window=window,
+                                                  out_shape=(src.count, y1 - y0, x1 - x0),
+                                                  resampling=Resampling.average)
+    return out
+
+
+def coarse_pass(src, func, factor, data_to_rgb=chw_to_hwc, sample_size=(512, 512), bound=128, **kwargs):
+    # Segmentation of the downsampled raster, every tile covers factor^2 times the area
+    ch, cw = -(-src.height // factor), -(-src.width // factor)
+    sh, sw = sample_size
+    sample_grid = calculate_sample_grid(raster_h=ch, raster_w=cw, sample_h=sh, sample_w=sw, bound=bound)
+
+    coarse = np.zeros((ch, cw), dtype=np.uint8)
+    process_sample_grid(sample_grid,
+                        read=lambda b: read_decimated_block(src, factor, **b),
+                        write=lambda b, uin8_out: write_array_block(coarse, uin8_out, **b),
+                        func=func,
+                        data_to_rgb=data_to_rgb,
+                        **kwargs)
+    return coarse
+
+
+def blocks_to_refine(coarse, factor, sample_grid, min_object_area=64, max_objects=16):
+    # Grid blocks (y, x) whose area has coarse objects smaller than min_object_area
+    # coarse pixels (near the coarse resolution limit), or more than max_objects
+    # objects. Empty and uniform areas are settled by the coarse pass
+    _, labels, stats, _ = cv2.connectedComponentsWithStats((coarse > 0).astype(np.uint8), connectivity=4)
+    small = stats[:, cv2.CC_STAT_AREA] < min_object_area
+    small[0] = False
+    small_mask = small[labels]
+
+    refine = set()
+    for b in sample_grid:
+        # Cropped block area in coarse pixels
+        (top, bottom), (left, right) = b['bounds']
+        y0, x0 = max(b['y'] + top, 0) // factor, max(b['x'] + left, 0) // factor
+        y1 = -(-(b['y'] + b['height'] - bottom) // factor)
+        x1 = -(-(b['x'] + b['width'] - right) // factor)
+        if y1 <= y0 or x1 <= x0:
+            continue
+
+        region = labels[y0:y1, x0:x1]
+        if small_mask[y0:y1, x0:x1].any() or len(np.unique(region[region > 0])) > max_objects:
+            refine.add((b['y'], b['x']))
+    return refine
+
+
+def upsample_block(coarse, factor, raster_h, raster_w, x, y, height, width, **kwargs):
+    rows = np.clip(np.arange(y, y + height), 0, raster_h - 1) // factor
+    cols = np.clip(np.arange(x, x + width), 0, raster_w - 1) // factor
+    return coarse[np.ix_(rows, cols)]
+
+
+def tiff_to_tiff(src_fp, dst_fp, func,
+                 data_to_rgb=chw_to_hwc,
+                 sample_size=(512, 512),
+                 sample_resize=None,
+                 bound=128,
+                 coarse_factor=4,
+                 min_object_area=64,
+                 max_objects=16,
+                 batch_size=1,
+                 prefetch=0,
+                 skip_invalid=False,
+                 aligned_reads=True,
+                 cog=False,
+                 block_size=512,
+                 num_threads='ALL_CPUS'):
+    # Coarse-to-fine sliding_window.tiff_to_tiff: the raster downsampled by
+    # coarse_factor is segmented first, full resolution tiles run only where
+    # the coarse result has small objects or many of them, elsewhere the
+    # upsampled coarse result is written. Returns (refined blocks, all blocks)
+    with open_source(src_fp) as src:
+        profile = src.profile
+        rh, rw = src.height, src.width
+        profile['count'] = 1
+        profile['dtype'] = 'uint8'
+
+        coarse = coarse_pass(src, func, coarse_factor, data_to_rgb, sample_size, bound,
+                             sample_resize=sample_resize, batch_size=batch_size, prefetch=prefetch)
+
+        sh, sw = sample_size
+        sample_grid = calculate_sample_grid(raster_h=rh, raster_w=rw, sample_h=sh, sample_w=sw, bound=bound)
+        if aligned_reads:
+            sample_grid = order_sample_grid(sample_grid, *src.block_shapes[0])
+        refine = blocks_to_refine(coarse, coarse_factor, sample_grid, min_object_area, max_objects)
+
+        # Settled blocks are not read, so they skip inference like empty blocks
+        read_full, read_valid = block_readers(src, skip_invalid, aligned_reads, sh + 2 * bound)
+        read = lambda b: read_full(b) if (b['y'], b['x']) in refine else None
+
+        def write(b, uin8_out):
+            if (b['y'], b['x']) not in refine:
+                uin8_out = upsample_block(coarse, coarse_factor, rh, rw, **b)
+            writer.write(b, uin8_out)
+
+        out_fp = dst_fp + '.part.tif' if cog else dst_fp
+        with BufferedBlockWriter(out_fp, profile, block_size, num_threads) as writer:
+            process_sample_grid(sample_grid, read, write, func,
+                                data_to_rgb=data_to_rgb,
+                                sample_resize=sample_resize,
+                                batch_size=batch_size,
+                                prefetch=prefetch,
+                                read_valid=read_valid)
+
+    if cog:
+        write_cog(out_fp, dst_fp, block_size, num_threads)
+        os.remove(out_fp)
+    return len(refine), len(sample_grid)
@@ -0,0 +1,33 @@
+import json
+import sqlite3
+
+
+class JobJournal:
+    # Sidecar SQLite file that records which sample grid blocks are already
+    # written to the output, so an interrupted job can be resumed
+
+    def __init__(self, path, grid_params):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS blocks (y INTEGER, x INTEGER, PRIMARY KEY (y, x))')
+
+        # A journal is only valid for the sample grid it was started with
+        grid_params = json.dumps(grid_params, sort_keys=True)
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'grid'").fetchone()
+        if row is None:
+            with self.conn:
+                self.conn.execute("INSERT INTO meta VALUES ('grid', ?)", (grid_params,))
+        elif row[0] != grid_params:
+            self.conn.close()
+            raise ValueError(f'Journal {path} was started with different parameters: {row[0]}')
+
+    def completed(self):
+        return set(self.conn.execute('SELECT y, x FROM blocks'))
+
+    def mark_done(self, blocks):
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO blocks VALUES (?, ?)', blocks)
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,128 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from rasterio.windows import Window
+
+from mosaic import open_source
+from sliding_window import (block_readers, calculate_sample_grid, chw_to_hwc, crop_block,
+                            infer_stage, read_stage)
+
+
+class LazySegmentationRaster:
+    # Segmentation of a GeoTIFF evaluated on demand: read(window) runs func only
+    # on the sample grid blocks intersecting the window. Cropped block outputs
+    # are kept in an LRU cache of cache_blocks blocks, reads are thread safe
+
+    def __init__(self, src_fp, func,
+                 data_to_rgb=chw_to_hwc,
+                 sample_size=(512, 512),
+                 sample_resize=None,
+                 bound=128,
+                 batch_size=1,
+                 cache_blocks=64,
+                 skip_invalid=False,
+                 aligned_reads=True):
+        self.src = open_source(src_fp)
+        self.func = func
+        self.data_to_rgb = data_to_rgb
+        self.sample_size = sample_size
+        self.sample_resize = sample_resize
+        self.batch_size = batch_size
+        self.cache_blocks = max(1, cache_blocks)
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+        sh, sw = sample_size
+        self.sample_grid = calculate_sample_grid(raster_h=self.height, raster_w=self.width,
+                                                 sample_h=sh, sample_w=sw, bound=bound)
+        # Cropped grid blocks tile the raster row by row with a (sh, sw) step,
+        # the grid can have an extra (empty) column, like calculate_sample_grid
+        self.grid_cols = len(range(-bound, self.width, sw))
+        self.read_src, self.read_valid = block_readers(self.src, skip_invalid, aligned_reads,
+                                                       sh + 2 * bound)
+
+    @property
+    def height(self):
+        return self.src.height
+
+    @property
+    def width(self):
+        return self.src.width
+
+    @property
+    def shape(self):
+        return self.src.height, self.src.width
+
+    @property
+    def crs(self):
+        return self.src.crs
+
+    @property
+    def transform(self):
+        return self.src.transform
+
+    @property
+    def profile(self):
+        return dict(self.src.profile, count=1, dtype='uint8')
+
+    def window_transform(self, window):
+        return self.src.window_transform(window)
+
+    def read(self, window=None):
+        # window is a rasterio Window or ((row_start, row_stop), (col_start, col_stop)),
+        # the part of it outside the raster reads as zeros
+        if window is None:
+            window = Window(0, 0, self.width, self.height)
+        elif not isinstance(window, Window):
+            window = Window.from_slices(*window, boundless=True)
+        window = window.round_offsets().round_lengths()
+        y, x, height, width = int(window.row_off), int(window.col_off), int(window.height), int(window.width)
+        out = np.zeros((height, width), dtype=np.uint8)
+
+        y0, x0 = max(y, 0), max(x, 0)
+        y1, x1 = min(y + height, self.height), min(x + width, self.width)
+        if y1 <= y0 or x1 <= x0:
+            return out
+
+        sh, sw = self.sample_size
+        indices = [row * self.grid_cols + col
+                   for row in range(y0 // sh, (y1 - 1) // sh + 1)
+                   for col in range(x0 // sw, (x1 - 1) // sw + 1)]
+
+        with self.lock:
+            for block, by, bx in self.blocks(indices):
+                # Intersection of the block and the requested window
+                iy0, iy1 = max(y0, by), min(y1, by + block.shape[0])
+                ix0, ix1 = max(x0, bx), min(x1, bx + block.shape[1])
+                out[iy0 - y:iy1 - y, ix0 - x:ix1 - x] = block[iy0 - by:iy1 - by, ix0 - bx:ix1 - bx]
+        return out
+
+    def blocks(self, indices):
+        # (cropped output, y, x) of grid blocks, missing ones are inferred in batches
+        missing = [i for i in indices if i not in self.cache]
+        computed = {}
+        if missing:
+            items = read_stage([self.sample_grid[i] for i in missing], self.read_src,
+                               self.data_to_rgb, self.sample_resize, self.read_valid)
+            outputs = infer_stage(items, self.func, self.sample_resize, self.batch_size)
+            for i, (b, uin8_out) in zip(missing, outputs):
+                raster, by, bx, _, _ = crop_block(uin8_out, **b)
+                computed[i] = (raster, by, bx)
+
+        blocks = [computed[i] if i in computed else self.cache[i] for i in indices]
+        for i, block in zip(indices, blocks):
+            self.cache[i] = block
+            self.cache.move_to_end(i)
+        while len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last=False)
+        return blocks
+
+    def close(self):
+        self.src.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
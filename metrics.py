@@ -0,0 +1,207 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+
+# Metrics collected by stage timers, None when no collection is active
+_active = None
+
+
+class StageMetrics:
+    # Latencies and pixel counts per pipeline stage, thread safe. Events are
+    # passed to the sinks as they come, summaries when the collection ends
+
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+        self.lock = threading.Lock()
+        self.seconds = defaultdict(list)
+        self.pixels = defaultdict(int)
+
+    def record(self, stage, seconds, pixels=0):
+        with self.lock:
+            self.seconds[stage].append(seconds)
+            self.pixels[stage] += pixels
+            for sink in self.sinks:
+                sink.event(stage, seconds, pixels)
+
+    def summary(self):
+        # stage -> count, total seconds, p50 / p95 milliseconds and pixels per second
+        with self.lock:
+            return {stage: summarize(seconds, self.pixels[stage])
+                    for stage, seconds in self.seconds.items()}
+
+    def close(self):
+        summary = self.summary()
+        for sink in self.sinks:
+            sink.summary(summary)
+            sink.close()
+        return summary
+
+
+class JsonLinesSink:
+    # An event line per timed stage call and a summary line at the end
+
+    def __init__(self, fp, events=True):
+        self.file = open(fp, 'a')
+        self.events = events
+
+    def event(self, stage, seconds, pixels):
+        if self.events:
+            self.file.write(json.dumps({'time': time.time(), 'stage': stage,
+                                        'seconds': seconds, 'pixels': pixels}) + '\n')
+
+    def summary(self, summary):
+        self.file.write(json.dumps({'time': time.time(), 'summary': summary}) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class PrometheusTextSink:
+    # Summary in the Prometheus text format, e.g. for the node exporter
+    # textfile collector. Rewritten every `every` events and at the end
+
+    def __init__(self, fp, metrics=None, every=100, prefix='sameo_stage'):
+        self.fp = fp
+        self.metrics = metrics
+        self.every = every
+        self.prefix = prefix
+        self.events = 0
+
+    def event(self, stage, seconds, pixels):
+        self.events += 1
+        # Called under the metrics lock
+        if self.metrics is not None and self.events % self.every == 0:
+            self.write({stage: summarize(values, self.metrics.pixels[stage])
+                        for stage, values in self.metrics.seconds.items()})
+
+    def summary(self, summary):
+        self.write(summary)
+
+    def write(self, summary):
+        p = self.prefix
+        lines = [f'# TYPE {p}_calls_total counter',
+                 f'# TYPE {p}_seconds_total counter',
+                 f'# TYPE {p}_latency_seconds gauge',
+                 f'# TYPE {p}_pixels_per_second gauge']
+        for stage, s in sorted(summary.items()):
+            lines += [f'{p}_calls_total{{stage="{stage}"}} {s["count"]}',
+                      f'{p}_seconds_total{{stage="{stage}"}} {s["total_s"]:.6f}',
+                      f'{p}_latency_seconds{{stage="{stage}",quantile="0.5"}} {s["p50_ms"] / 1000:.6f}',
+                      f'{p}_latency_seconds{{stage="{stage}",quantile="0.95"}} {s["p95_ms"] / 1000:.6f}',
+                      f'{p}_pixels_per_second{{stage="{stage}"}} {s["pixels_per_s"]:.1f}']
+        # Replaced at once, so a collector never reads a half written file
+        with open(self.fp + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(self.fp + '.tmp', self.fp)
+
+    def close(self):
+        pass
+
+
+def summarize(seconds, pixels):
+    seconds = np.asarray(seconds)
+    total = float(seconds.sum())
+    return {'count': len(seconds),
+            'total_s': total,
+            'p50_ms': float(np.percentile(seconds, 50) * 1000),
+            'p95_ms': float(np.percentile(seconds, 95) * 1000),
+            'pixels': pixels,
+            'pixels_per_s': pixels / total if total > 0 else 0.0}
+
+
+def format_summary(summary):
+    lines = [f'{"stage":<26}{"count":>8}{"total s":>10}{"p50 ms":>10}{"p95 ms":>10}{"Mpx/s":>10}']
+    for stage, s in sorted(summary.items(), key=lambda item: -item[1]['total_s']):
+        lines.append(f'{stage:<26}{s["count"]:>8}{s["total_s"]:>10.2f}{s["p50_ms"]:>10.1f}'
+                     f'{s["p95_ms"]:>10.1f}{s["pixels_per_s"] / 1e6:>10.2f}')
+    return '\n'.join(lines)
+
+
+@contextmanager
+def collect(sinks=(), verbose=True):
+    # Stage timers record into the yielded StageMetrics while the block runs,
+    # the summary is printed at the end with verbose=True. Worker processes
+    # of the sliding window pool are not covered
+    global _active
+    metrics = StageMetrics(sinks)
+    for sink in metrics.sinks:
+        if isinstance(sink, PrometheusTextSink) and sink.metrics is None:
+            sink.metrics = metrics
+    previous, _active = _active, metrics
+    try:
+        yield metrics
+    finally:
+        _active = previous
+        summary = metrics.close()
+        if verbose:
+            print(format_summary(summary))
+
+
+def sync_cuda():
+    if torch.cuda.is_initialized():
+        torch.cuda.synchronize()
+
+
+@contextmanager
+def timer(stage, pixels=0, sync=False):
+    # With sync=True CUDA is synchronized around the block, so queued kernels
+    # are counted in the stage they belong to
+    if _active is None:
+        yield
+        return
+    if sync:
+        sync_cuda()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if sync:
+            sync_cuda()
+        _active.record(stage, time.perf_counter() - start, pixels)
+
+
+class ModuleTimer:
+    # Forward hooks timing a torch module, the pixels are those of the first
+    # (image batch) input. CUDA is synchronized only while collecting. A module
+    # level class, so modules with the hooks stay picklable (e.g. for spawned
+    # sliding window workers)
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.local = threading.local()
+
+    def __getstate__(self):
+        return {'stage': self.stage}
+
+    def __setstate__(self, state):
+        self.__init__(state['stage'])
+
+    def before(self, module, args, kwargs):
+        if _active is not None:
+            sync_cuda()
+            self.local.start = time.perf_counter()
+
+    def after(self, module, args, kwargs, outputs):
+        if _active is not None and getattr(self.local, 'start', None) is not None:
+            sync_cuda()
+            first = args[0] if args else next(iter(kwargs.values()), None)
+            pixels = 0
+            if isinstance(first, torch.Tensor) and first.dim() == 4:
+                pixels = first.shape[0] * first.shape[-2] * first.shape[-1]
+            _active.record(self.stage, time.perf_counter() - self.local.start, pixels)
+            self.local.start = None
+
+
+def time_module(module, stage):
+    # Times the forward calls of a torch module with hooks
+    hooks = ModuleTimer(stage)
+    module.register_forward_pre_hook(hooks.before, with_kwargs=True)
+    module.register_forward_hook(hooks.after, with_kwargs=True)
+    return hooks
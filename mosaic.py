@@ -0,0 +1,191 @@
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import rasterio
+import shapely
+from rasterio.enums import MaskFlags, Resampling
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform, transform_bounds
+from rasterio.windows import Window, from_bounds
+
+
+class MosaicDataset:
+    # Read-only raster over many scenes sharing band count and data type,
+    # without merging them. Windows are read from the scenes whose footprints
+    # intersect them (STRtree of footprints), later scenes are painted over
+    # earlier ones where they are valid. At most max_open scenes stay open.
+    # The mosaic grid is in crs (default the CRS of the first scene) at
+    # resolution (default the native one), scenes in another CRS or resolution
+    # are warped window by window through a WarpedVRT on the mosaic grid. GDAL
+    # approximates the warp transform within tolerance pixels per chunk, so
+    # overlapping windows can differ by a sub-pixel shift unless it is tiny.
+    # Quacks like the parts of a rasterio dataset the sliding window uses
+
+    def __init__(self, paths, crs=None, resolution=None, resampling=Resampling.bilinear,
+                 tolerance=0.125, max_open=64, block_size=512):
+        self.paths = [str(p) for p in paths]
+        if not self.paths:
+            raise ValueError('Mosaic needs at least one source')
+        if isinstance(resolution, (int, float)):
+            resolution = (resolution, resolution)
+        self.resampling = Resampling[resampling] if isinstance(resampling, str) else resampling
+        self.tolerance = tolerance
+        self.max_open = max(1, max_open)
+        self.handles = OrderedDict()
+        self.lock = threading.RLock()
+
+        footprints = []
+        self.warped = []
+        for path in self.paths:
+            with rasterio.open(path) as src:
+                if not footprints:
+                    self.crs = rasterio.crs.CRS.from_user_input(crs) if crs is not None else src.crs
+                    self.count = src.count
+                    self.dtypes = src.dtypes
+                    nodata = src.nodata if src.nodata is not None else 0
+                    if resolution is None and src.crs == self.crs:
+                        resolution = src.res
+                    elif resolution is None:
+                        transform, _, _ = calculate_default_transform(src.crs, self.crs, src.width, src.height,
+                                                                      *src.bounds)
+                        resolution = (transform.a, -transform.e)
+                elif (src.count, src.dtypes[0]) != (self.count, self.dtypes[0]):
+                    raise ValueError(f'{path} differs from {self.paths[0]} in band count or data type')
+
+                if src.crs == self.crs:
+                    footprints.append(src.bounds)
+                else:
+                    footprints.append(rasterio.coords.BoundingBox(*transform_bounds(src.crs, self.crs, *src.bounds)))
+                self.warped.append(src.crs != self.crs or not np.allclose(src.res, resolution))
+
+        left = min(b.left for b in footprints)
+        bottom = min(b.bottom for b in footprints)
+        right = max(b.right for b in footprints)
+        top = max(b.top for b in footprints)
+        xres, yres = resolution
+        self.transform = from_origin(left, top, xres, yres)
+        self.width = max(1, int(math.ceil((right - left) / xres - 1e-6)))
+        self.height = max(1, int(math.ceil((top - bottom) / yres - 1e-6)))
+        self.bounds = rasterio.coords.BoundingBox(left, top - self.height * yres, left + self.width * xres, top)
+        self.res = (xres, yres)
+
+        self.nodata = nodata
+        self.nodatavals = (nodata,) * self.count
+        self.mask_flag_enums = ([MaskFlags.nodata],) * self.count
+        self.block_shapes = [(block_size, block_size)] * self.count
+        # The sources, so open_source(name) opens the mosaic again (e.g. in workers)
+        self.name = {'src': self.paths, 'crs': self.crs.to_string(), 'resolution': self.res,
+                     'resampling': self.resampling.name, 'tolerance': tolerance}
+
+        self.footprints = footprints
+        self.index = shapely.STRtree([shapely.box(*b) for b in footprints])
+
+    @property
+    def profile(self):
+        bh, bw = self.block_shapes[0]
+        return {'driver': 'GTiff', 'width': self.width, 'height': self.height, 'count': self.count,
+                'dtype': self.dtypes[0], 'crs': self.crs, 'transform': self.transform,
+                'nodata': self.nodata, 'tiled': True, 'blockxsize': bw, 'blockysize': bh,
+                'compress': 'deflate'}
+
+    def overviews(self, band):
+        return []
+
+    def window_transform(self, window):
+        return rasterio.windows.transform(window, self.transform)
+
+    def scene(self, i):
+        # Open handle pool, least recently used scenes are closed
+        if i in self.handles:
+            self.handles.move_to_end(i)
+            return self.handles[i]
+        src = rasterio.open(self.paths[i])
+        if self.warped[i]:
+            # Warped onto the mosaic grid, so it is read with mosaic windows
+            src = WarpedVRT(src, crs=self.crs, transform=self.transform, width=self.width,
+                            height=self.height, resampling=self.resampling, tolerance=self.tolerance,
+                            nodata=src.nodata if src.nodata is not None else self.nodata)
+        self.handles[i] = src
+        if len(self.handles) > self.max_open:
+            self.handles.popitem(last=False)[1].close()
+        return src
+
+    def read(self, window=None, boundless=False, fill_value=None, out_shape=None,
+             resampling=Resampling.nearest, **kwargs):
+        if window is None:
+            window = Window(0, 0, self.width, self.height)
+        elif not isinstance(window, Window):
+            window = Window.from_slices(*window, boundless=True)
+        if out_shape is None:
+            out_shape = (self.count, int(round(window.height)), int(round(window.width)))
+        elif len(out_shape) == 2:
+            out_shape = (self.count,) + tuple(out_shape)
+        oh, ow = out_shape[1:]
+        fill_value = self.nodata if fill_value is None else fill_value
+        out = np.full(out_shape, fill_value, dtype=self.dtypes[0])
+
+        # Output pixel size in mosaic pixels
+        sy, sx = window.height / oh, window.width / ow
+        w_left, w_top = self.transform * (window.col_off, window.row_off)
+        w_right, w_bottom = self.transform * (window.col_off + window.width, window.row_off + window.height)
+        xres, yres = self.res
+
+        with self.lock:
+            for i in sorted(self.index.query(shapely.box(w_left, w_bottom, w_right, w_top))):
+                fp = self.footprints[i]
+                # Output pixels covered by the scene
+                ox0 = max(int(math.floor((fp.left - w_left) / (xres * sx) + 1e-6)), 0)
+                ox1 = min(int(math.ceil((fp.right - w_left) / (xres * sx) - 1e-6)), ow)
+                oy0 = max(int(math.floor((w_top - fp.top) / (yres * sy) + 1e-6)), 0)
+                oy1 = min(int(math.ceil((w_top - fp.bottom) / (yres * sy) - 1e-6)), oh)
+                if ox1 <= ox0 or oy1 <= oy0:
+                    continue
+
+                src = self.scene(i)
+                shape = (oy1 - oy0, ox1 - ox0)
+                if self.warped[i]:
+                    # WarpedVRTs can't read boundless, the window stays inside the mosaic
+                    scene_window = Window(window.col_off + ox0 * sx, window.row_off + oy0 * sy,
+                                          shape[1] * sx, shape[0] * sy)
+                    scene_window = scene_window.intersection(Window(0, 0, self.width, self.height))
+                    boundless = False
+                else:
+                    scene_window = from_bounds(w_left + ox0 * xres * sx, w_top - oy1 * yres * sy,
+                                               w_left + ox1 * xres * sx, w_top - oy0 * yres * sy,
+                                               transform=src.transform)
+                    boundless = True
+                data = src.read(window=scene_window, out_shape=(self.count,) + shape,
+                                boundless=boundless, fill_value=fill_value, resampling=resampling)
+                if all(MaskFlags.all_valid in f for f in src.mask_flag_enums):
+                    out[:, oy0:oy1, ox0:ox1] = data
+                else:
+                    valid = src.dataset_mask(window=scene_window, out_shape=shape,
+                                             boundless=boundless, resampling=Resampling.nearest) > 0
+                    np.copyto(out[:, oy0:oy1, ox0:ox1], data, where=valid[None])
+        return out
+
+    def close(self):
+        with self.lock:
+            for src in self.handles.values():
+                src.close()
+            self.handles.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_source(src, crs=None, resolution=None, resampling='bilinear', tolerance=0.125):
+    # A path (GeoTIFF, VRT, ...) opens with rasterio, a list of paths as a mosaic.
+    # With a target crs or resolution the source is warped on the fly (a mosaic
+    # of one scene), a dict of these arguments is opened the same way
+    if isinstance(src, dict):
+        return open_source(**src)
+    if isinstance(src, (list, tuple)) or crs is not None or resolution is not None:
+        return MosaicDataset([src] if isinstance(src, str) else src, crs, resolution, resampling, tolerance)
+    return rasterio.open(src)
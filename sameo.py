@@ -1,7 +1,13 @@
+import inspect
 import numpy as np
 import cv2
 import sliding_window
+import coarse_to_fine
 import polygonization
+import batch_runner
+import metrics
+import tile_server
+from lazy_raster import LazySegmentationRaster
 from tms2geotiff.tms2geotiff import draw_tile
 from segment_anything import sam_model_registry, SamAutomaticMaskGenerator
 
@@ -22,6 +28,35 @@ from segment_anything import sam_model_registry, SamAutomaticMaskGenerator
 # min_mask_region_area: int = 0,
 # output_mode: str = "binary_mask",
 
+class TimedMaskGenerator(SamAutomaticMaskGenerator):
+    # Records the decoder, postprocess and small region stages inside
+    # metrics.collect(). The decoder is timed per prompt batch rather than with
+    # forward hooks, two-phase decoding (pred_iou_thresh > 0) does not run its
+    # forward. postprocess is the mask filtering, RLE encoding and NMS
+
+    def _decode_prompts(self, in_points, in_labels, image_embeddings):
+        pixels = image_embeddings.shape[0] * image_embeddings.shape[-2] * image_embeddings.shape[-1]
+        with metrics.timer('decoder', pixels, sync=True):
+            return super()._decode_prompts(in_points, in_labels, image_embeddings)
+
+    def _batch_to_mask_data(self, *args, **kwargs):
+        with metrics.timer('postprocess', sync=True):
+            return super()._batch_to_mask_data(*args, **kwargs)
+
+    def _finalize_crop(self, *args, **kwargs):
+        with metrics.timer('postprocess', sync=True):
+            return super()._finalize_crop(*args, **kwargs)
+
+    def _merge_crops(self, *args, **kwargs):
+        with metrics.timer('postprocess', sync=True):
+            return super()._merge_crops(*args, **kwargs)
+
+    @staticmethod
+    def postprocess_small_regions(*args, **kwargs):
+        with metrics.timer('postprocess_small_regions'):
+            return SamAutomaticMaskGenerator.postprocess_small_regions(*args, **kwargs)
+
+
 class SamEO:
     def __init__(self, checkpoint="sam_vit_h_4b8939.pth",
                  model_type='vit_h',
@@ -43,37 +78,124 @@ class SamEO:
         self.mask_multiplier = mask_multiplier 
             
     def reinit_sam(self):
-        self.sam = sam_model_registry[self.model_type](checkpoint=self.checkpoint)
+        # model_type is a sam_model_registry key or a builder taking checkpoint
+        build_sam = self.model_type if callable(self.model_type) else sam_model_registry[self.model_type]
+        self.sam = build_sam(checkpoint=self.checkpoint)
         self.sam.to(device=self.device)
         
         sam_kwargs = self.sam_kwargs if self.sam_kwargs is not None else {}
-        self.mask_generator = SamAutomaticMaskGenerator(self.sam, **sam_kwargs)
+        self.mask_generator = TimedMaskGenerator(self.sam, **sam_kwargs)
+
+        # Stage timings, recorded only inside metrics.collect()
+        metrics.time_module(self.sam.image_encoder, 'encoder')
     
-    def __call__(self, image):
-        h, w, _ = image.shape
-        
-        resulting_mask = np.zeros((h, w), dtype=np.uint8)
-        resulting_borders = np.zeros((h, w), dtype=np.uint8)
+    def share_memory(self):
+        # Lets sliding_window worker processes use one copy of the weights
+        self.sam.share_memory()
+        return self
+
+    def __call__(self, image, valid_mask=None):
+        with metrics.timer('amg', image.shape[0] * image.shape[1]):
+            masks = self.mask_generator.generate(image, valid_mask)
+        with metrics.timer('composite', image.shape[0] * image.shape[1]):
+            return self.masks_to_raster(image.shape[:2], masks)
+
+    # Tile-batch protocol of sliding_window: encode all tiles in one forward
+    def batch_call(self, images, valid_masks=None):
+        with metrics.timer('amg', sum(image.shape[0] * image.shape[1] for image in images)):
+            masks_batch = self.mask_generator.generate_batch(images, valid_masks)
+        with metrics.timer('composite', sum(image.shape[0] * image.shape[1] for image in images)):
+            return [self.masks_to_raster(image.shape[:2], masks)
+                    for image, masks in zip(images, masks_batch)]
+
+    def mask_records(self, masks):
+        # The masks of generate as a list of records, whatever the record_format
+        record_format = self.mask_generator.record_format
+        if record_format == 'list':
+            return masks
+        if record_format == 'recarray':
+            masks = {k: masks[k] for k in ('segmentation', 'bbox', 'predicted_iou')}
+        return [{'segmentation': segmentation, 'bbox': bbox, 'predicted_iou': predicted_iou}
+                for segmentation, bbox, predicted_iou
+                in zip(masks['segmentation'], masks['bbox'], masks['predicted_iou'])]
+
+    def masks_to_labels(self, image_hw, masks):
+        if self.mask_generator.output_mode == 'label_map':
+            # Painted by the mask generator
+            return masks['segmentation']
+        masks = self.mask_records(masks)
+        labels = np.zeros(image_hw, dtype=np.int32)
+        # Best masks are painted last, so they win where masks overlap
+        for i, m in enumerate(sorted(masks, key=lambda m: m['predicted_iou'])):
+            labels[m['segmentation'] > 0] = i + 1
+        return labels
+
+    def masks_to_raster(self, image_hw, masks):
+        # Union of the masks minus the union of their edges (mask - eroded mask).
+        # Every mask is composited within its bounding box padded by the kernel
+        # size rather than over the whole tile, bool accumulators can't overflow
+        if self.mask_generator.output_mode == 'label_map':
+            return self.label_map_to_raster(masks['segmentation'])
+        masks = self.mask_records(masks)
+        h, w = image_hw
+        pad = max(self.erosion_kernel.shape) if self.erosion_kernel is not None else 0
+
+        resulting_mask = np.zeros((h, w), dtype=bool)
+        resulting_borders = np.zeros((h, w), dtype=bool)
 
-        masks = self.mask_generator.generate(image)
         for m in masks:
-            mask = (m['segmentation'] > 0).astype(np.uint8)
-            resulting_mask += mask
+            rows, cols = mask_window(m, pad, h, w)
+            mask = m['segmentation'][rows, cols] > 0
+            resulting_mask[rows, cols] |= mask
 
             if self.erosion_kernel is not None:
+                mask = mask.astype(np.uint8)
                 mask_erode = cv2.erode(mask, self.erosion_kernel, iterations=1)
-                mask_erode = (mask_erode > 0).astype(np.uint8)
-                edge_mask = mask - mask_erode
-                resulting_borders += edge_mask
-        
-        resulting_mask = (resulting_mask > 0).astype(np.uint8)
-        resulting_borders = (resulting_borders > 0).astype(np.uint8)
-        resulting_mask_with_borders = resulting_mask - resulting_borders
-        return resulting_mask_with_borders *self.mask_multiplier
+                resulting_borders[rows, cols] |= mask > mask_erode
+
+        resulting_mask_with_borders = (resulting_mask & ~resulting_borders).astype(np.uint8)
+        return resulting_mask_with_borders * self.mask_multiplier
     
-    def tiff_to_tiff(self, in_path, out_path, **kwargs):
-        return sliding_window.tiff_to_tiff(in_path, out_path, self, **kwargs)
+    def label_map_to_raster(self, labels):
+        # Instances minus their edges, the pixels with another id (or background)
+        # under the kernel. Where masks overlap only the painted one has edges
+        resulting_mask = labels > 0
+        if self.erosion_kernel is not None:
+            labels = labels.astype(np.float32)
+            edges = ((cv2.erode(labels, self.erosion_kernel) != labels) |
+                     (cv2.dilate(labels, self.erosion_kernel) != labels))
+            resulting_mask &= ~edges
+        return resulting_mask.astype(np.uint8) * self.mask_multiplier
+
+    def tiff_to_tiff(self, in_path, out_path, stitch=False, coarse_factor=None, **kwargs):
+        # coarse_factor enables the coarse-to-fine pass, see coarse_to_fine.tiff_to_tiff
+        if coarse_factor is not None:
+            unsupported = ['stitch=True'] if stitch else []
+            accepted = inspect.signature(coarse_to_fine.tiff_to_tiff).parameters
+            unsupported += [k for k in kwargs if k not in accepted]
+            if unsupported:
+                raise ValueError(f'{", ".join(unsupported)} can not be combined with coarse_factor')
+            return coarse_to_fine.tiff_to_tiff(in_path, out_path, self, coarse_factor=coarse_factor, **kwargs)
+        func = InstanceLabels(self) if stitch else self
+        return sliding_window.tiff_to_tiff(in_path, out_path, func, stitch=stitch, **kwargs)
     
+    def batch_tiff_to_tiff(self, sources, out_dir, to_gpkg=False, simplify_tolerance=None, **kwargs):
+        # The loaded model is reused for all scenes, see batch_runner.list_scenes for sources
+        return batch_runner.run_batch(self, sources, out_dir, to_gpkg, simplify_tolerance, **kwargs)
+
+    def lazy_raster(self, in_path, **kwargs):
+        # Segments only the windows that are read, see lazy_raster.LazySegmentationRaster
+        return LazySegmentationRaster(in_path, self, **kwargs)
+
+    def serve_tiles(self, in_path, host='127.0.0.1', port=8000, cache_dir=None,
+                    max_cache_bytes=512 * 2 ** 20, **kwargs):
+        # XYZ PNG tiles segmented on demand, cached in <in_path>.tiles by default.
+        # The cache does not know the model settings, clear it when they change
+        cache_dir = cache_dir if cache_dir is not None else in_path + '.tiles'
+        with LazySegmentationRaster(in_path, self, **kwargs) as raster:
+            tiles = tile_server.SegmentationTiles(raster, cache_dir, max_cache_bytes)
+            tile_server.serve(tiles, host, port)
+
     def image_to_image(self, image, **kwargs):
         return sliding_window.image_to_image(image, self, **kwargs)
 
@@ -83,4 +205,35 @@ class SamEO:
         return image
 
     def tiff_to_gpkg(self, tiff_path, gpkg_path, simplify_tolerance=None):
-        polygonization.tiff_to_gpkg(tiff_path, gpkg_path, simplify_tolerance)
\ No newline at end of file
+        polygonization.tiff_to_gpkg(tiff_path, gpkg_path, simplify_tolerance)
+
+
+def mask_window(m, pad, h, w):
+    # Rows and columns of the mask bounding box (XYWH, inclusive corners as in
+    # SamAutomaticMaskGenerator) grown by pad pixels, the whole tile without one.
+    # The padding keeps the erosion of the mask away from the window edges
+    if 'bbox' not in m:
+        return slice(None), slice(None)
+    x, y, bw, bh = (int(v) for v in m['bbox'])
+    return (slice(max(y - pad, 0), min(y + bh + 1 + pad, h)),
+            slice(max(x - pad, 0), min(x + bw + 1 + pad, w)))
+
+
+class InstanceLabels:
+    # Sliding window callable giving per-tile instance labels of a SamEO,
+    # used by the stitching mode of sliding_window
+    def __init__(self, sam_eo):
+        self.sam_eo = sam_eo
+
+    def share_memory(self):
+        self.sam_eo.share_memory()
+        return self
+
+    def __call__(self, image, valid_mask=None):
+        masks = self.sam_eo.mask_generator.generate(image, valid_mask)
+        return self.sam_eo.masks_to_labels(image.shape[:2], masks)
+
+    def batch_call(self, images, valid_masks=None):
+        masks_batch = self.sam_eo.mask_generator.generate_batch(images, valid_masks)
+        return [self.sam_eo.masks_to_labels(image.shape[:2], masks)
+                for image, masks in zip(images, masks_batch)]
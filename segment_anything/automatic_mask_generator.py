@@ -8,24 +8,26 @@ import numpy as np
 import torch
 from torchvision.ops.boxes import batched_nms, box_area  # type: ignore
 
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from .modeling import Sam
 from .predictor import SamPredictor
 from .utils.amg import (
     MaskData,
-    area_from_rle,
+    areas_from_rles,
     batch_iterator,
     batched_mask_to_box,
     box_xyxy_to_xywh,
     build_all_layer_point_grids,
     calculate_stability_score,
-    coco_encode_rle,
+    coco_encode_rles,
+    crop_masks_to_boxes,
     generate_crop_boxes,
     is_box_near_crop_edge,
     mask_to_rle_pytorch,
+    paint_label_map,
     remove_small_regions,
-    rle_to_mask,
+    rles_to_masks,
     uncrop_boxes_xyxy,
     uncrop_masks,
     uncrop_points,
@@ -49,6 +51,8 @@ class SamAutomaticMaskGenerator:
         point_grids: Optional[List[np.ndarray]] = None,
         min_mask_region_area: int = 0,
         output_mode: str = "binary_mask",
+        record_format: str = "list",
+        low_res_filtering: bool = False,
     ) -> None:
         """
         Using a SAM model, generates masks for the entire image.
@@ -65,7 +69,9 @@ class SamAutomaticMaskGenerator:
           points_per_batch (int): Sets the number of points run simultaneously
             by the model. Higher numbers may be faster but use more GPU memory.
           pred_iou_thresh (float): A filtering threshold in [0,1], using the
-            model's predicted mask quality.
+            model's predicted mask quality. When above 0, the mask decoder
+            predicts the quality first and synthesizes only the masks that
+            pass the threshold.
           stability_score_thresh (float): A filtering threshold in [0,1], using
             the stability of the mask under changes to the cutoff used to binarize
             the model's mask predictions.
@@ -90,9 +96,18 @@ class SamAutomaticMaskGenerator:
             to remove disconnected regions and holes in masks with area smaller
             than min_mask_region_area. Requires opencv.
           output_mode (str): The form masks are returned in. Can be 'binary_mask',
-            'uncompressed_rle', or 'coco_rle'. 'coco_rle' requires pycocotools.
-            For large resolutions, 'binary_mask' may consume large amounts of
-            memory.
+            'uncompressed_rle', 'coco_rle', or 'label_map'. 'coco_rle' requires
+            pycocotools. For large resolutions, 'binary_mask' may consume large
+            amounts of memory. 'label_map' paints all masks into one int32
+            instance id raster without encoding them to RLEs, see 'generate'.
+          record_format (str): How 'generate' returns the masks. Can be 'list'
+            (a dict per mask), 'dict' (a dict of per-mask arrays) or 'recarray'
+            (a numpy record array). Ignored for output_mode='label_map'.
+          low_res_filtering (bool): If True, masks are filtered by predicted
+            IoU and by a stability score computed on the low resolution mask
+            logits before upscaling, and only the kept masks are upscaled, in
+            one interpolation straight to the crop size. Saves much of the
+            time and memory of a batch, the masks differ slightly.
         """
 
         assert (points_per_side is None) != (
@@ -113,7 +128,13 @@ class SamAutomaticMaskGenerator:
             "binary_mask",
             "uncompressed_rle",
             "coco_rle",
+            "label_map",
         ], f"Unknown output_mode {output_mode}."
+        assert record_format in [
+            "list",
+            "dict",
+            "recarray",
+        ], f"Unknown record_format {record_format}."
         if output_mode == "coco_rle":
             from pycocotools import mask as mask_utils  # type: ignore # noqa: F401
 
@@ -132,14 +153,20 @@ class SamAutomaticMaskGenerator:
         self.crop_n_points_downscale_factor = crop_n_points_downscale_factor
         self.min_mask_region_area = min_mask_region_area
         self.output_mode = output_mode
+        self.record_format = record_format
+        self.low_res_filtering = low_res_filtering
 
     @torch.no_grad()
-    def generate(self, image: np.ndarray) -> List[Dict[str, Any]]:
+    def generate(
+        self, image: np.ndarray, valid_mask: Optional[np.ndarray] = None
+    ) -> Union[List[Dict[str, Any]], Dict[str, np.ndarray]]:
         """
         Generates masks for the given image.
 
         Arguments:
           image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+          valid_mask (np.ndarray or None): An HW boolean mask of the pixels that
+            hold valid data. Point prompts falling outside it are dropped.
 
         Returns:
            list(dict(str, any)): A list over records for masks. Each record is
@@ -157,44 +184,136 @@ class SamAutomaticMaskGenerator:
                  is filtered on using the stability_score_thresh parameter.
                crop_box (list(float)): The crop of the image used to generate
                  the mask, given in XYWH format.
+           If record_format='dict', a dict with the same keys holding arrays
+             over the masks instead (Nx4 boxes, Nx2 point coordinates and, for
+             output_mode='binary_mask', NxHxW masks), with 'recarray' a numpy
+             record array with these fields.
+           If output_mode='label_map', a single dict of arrays instead:
+               segmentation (np.ndarray): An HW int32 label map. Instance i has
+                 the id i + 1, 0 is background. Masks with a higher predicted
+                 IoU are painted over those with a lower one.
+               predicted_iou, stability_score, area (np.ndarray): Per instance
+                 scores, sorted by descending predicted IoU. The area is the
+                 number of pixels the instance holds in the label map.
+               bbox, crop_box (np.ndarray): Nx4 boxes in XYWH format.
+               point_coords (np.ndarray): Nx2 point prompts.
         """
 
         # Generate masks
-        mask_data = self._generate_masks(image)
+        mask_data = self._generate_masks(image, valid_mask)
+        return self._mask_data_to_records(mask_data, image.shape[:2])
 
+    @torch.no_grad()
+    def generate_batch(
+        self,
+        images: List[np.ndarray],
+        valid_masks: Optional[List[Optional[np.ndarray]]] = None,
+    ) -> List[Union[List[Dict[str, Any]], Dict[str, np.ndarray]]]:
+        """
+        Generates masks for a batch of images. The crops of all images are
+        passed through the image encoder together, and their point prompts
+        are streamed through the mask decoder as one sequence of batches.
+
+        Arguments:
+          images (list(np.ndarray)): The images to generate masks for, each
+            in HWC uint8 format.
+          valid_masks (list(np.ndarray or None) or None): Optional HW boolean
+            masks of valid pixels, one per image. See 'generate'.
+
+        Returns:
+          (list(list(dict(str, any)))): A list over images, where each element
+            is the list of mask records 'generate' returns for that image
+            (the label map dict if output_mode='label_map').
+        """
+        mask_datas = self._generate_masks_batch(images, valid_masks)
+        return [
+            self._mask_data_to_records(mask_data, image.shape[:2])
+            for mask_data, image in zip(mask_datas, images)
+        ]
+
+    def _mask_data_to_records(
+        self, mask_data: MaskData, orig_size: Tuple[int, ...]
+    ) -> Union[List[Dict[str, Any]], Dict[str, Any], np.recarray]:
         # Filter small disconnected regions and holes in masks
         if self.min_mask_region_area > 0:
             mask_data = self.postprocess_small_regions(
                 mask_data,
                 self.min_mask_region_area,
                 max(self.box_nms_thresh, self.crop_nms_thresh),
+                orig_size,
             )
 
+        if self.output_mode == "label_map":
+            return self._mask_data_to_label_map(mask_data, orig_size)
+
         # Encode masks
         if self.output_mode == "coco_rle":
-            mask_data["segmentations"] = [coco_encode_rle(rle) for rle in mask_data["rles"]]
+            segmentations = coco_encode_rles(mask_data["rles"])
         elif self.output_mode == "binary_mask":
-            mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
+            segmentations = rles_to_masks(mask_data["rles"])
         else:
-            mask_data["segmentations"] = mask_data["rles"]
-
-        # Write mask records
+            segmentations = mask_data["rles"]
+
+        columns = {
+            "segmentation": segmentations,
+            "area": areas_from_rles(mask_data["rles"]),
+            "bbox": box_xyxy_to_xywh(mask_data["boxes"].T).T,
+            "predicted_iou": mask_data["iou_preds"],
+            "point_coords": mask_data["points"],
+            "stability_score": mask_data["stability_score"],
+            "crop_box": box_xyxy_to_xywh(mask_data["crop_boxes"].T).T,
+        }
+        if self.record_format == "dict":
+            return columns
+        if self.record_format == "recarray":
+            return self._columns_to_recarray(columns)
+
+        # Write mask records, converting every column to Python values at once
+        values = {k: v.tolist() for k, v in columns.items() if k != "segmentation"}
         curr_anns = []
-        for idx in range(len(mask_data["segmentations"])):
-            ann = {
-                "segmentation": mask_data["segmentations"][idx],
-                "area": area_from_rle(mask_data["rles"][idx]),
-                "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
-                "predicted_iou": mask_data["iou_preds"][idx].item(),
-                "point_coords": [mask_data["points"][idx].tolist()],
-                "stability_score": mask_data["stability_score"][idx].item(),
-                "crop_box": box_xyxy_to_xywh(mask_data["crop_boxes"][idx]).tolist(),
-            }
+        for idx in range(len(segmentations)):
+            ann = {"segmentation": segmentations[idx]}
+            ann.update((k, v[idx]) for k, v in values.items())
+            ann["point_coords"] = [ann["point_coords"]]
             curr_anns.append(ann)
 
         return curr_anns
 
-    def _generate_masks(self, image: np.ndarray) -> MaskData:
+    @staticmethod
+    def _columns_to_recarray(columns: Dict[str, Any]) -> np.recarray:
+        dtype = [("segmentation", object)] + [
+            (k, v.dtype, v.shape[1:]) for k, v in columns.items() if k != "segmentation"
+        ]
+        records = np.recarray(len(columns["area"]), dtype=dtype)
+        for k, v in columns.items():
+            if k == "segmentation":
+                for idx, segmentation in enumerate(v):
+                    records.segmentation[idx] = segmentation
+            else:
+                records[k] = v
+        return records
+
+    def _mask_data_to_label_map(
+        self, mask_data: MaskData, orig_size: Tuple[int, ...]
+    ) -> Dict[str, np.ndarray]:
+        # Best masks first, so they get the lowest ids and are painted last
+        order = np.argsort(-mask_data["iou_preds"], kind="stable")
+        boxes = mask_data["boxes"][order]
+        label_map = paint_label_map([mask_data["masks"][i] for i in order], boxes, orig_size)
+        area = np.bincount(label_map.ravel(), minlength=len(order) + 1)[1:]
+        return {
+            "segmentation": label_map,
+            "area": area,
+            "bbox": box_xyxy_to_xywh(boxes.T).T,
+            "predicted_iou": mask_data["iou_preds"][order],
+            "point_coords": mask_data["points"][order],
+            "stability_score": mask_data["stability_score"][order],
+            "crop_box": box_xyxy_to_xywh(mask_data["crop_boxes"][order].T).T,
+        }
+
+    def _generate_masks(
+        self, image: np.ndarray, valid_mask: Optional[np.ndarray] = None
+    ) -> MaskData:
         orig_size = image.shape[:2]
         crop_boxes, layer_idxs = generate_crop_boxes(
             orig_size, self.crop_n_layers, self.crop_overlap_ratio
@@ -203,9 +322,98 @@ class SamAutomaticMaskGenerator:
         # Iterate over image crops
         data = MaskData()
         for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
+            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size, valid_mask)
             data.cat(crop_data)
 
+        return self._merge_crops(data, crop_boxes)
+
+    def _generate_masks_batch(
+        self,
+        images: List[np.ndarray],
+        valid_masks: Optional[List[Optional[np.ndarray]]] = None,
+    ) -> List[MaskData]:
+        if valid_masks is None:
+            valid_masks = [None] * len(images)
+
+        # Collect the crops of every image
+        crops = []
+        for image_idx, image in enumerate(images):
+            orig_size = image.shape[:2]
+            crop_boxes, layer_idxs = generate_crop_boxes(
+                orig_size, self.crop_n_layers, self.crop_overlap_ratio
+            )
+            for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
+                crops.append((image_idx, crop_box, layer_idx, orig_size))
+
+        # Encode as many crops at once as there are images
+        crop_datas = []
+        for (crops_chunk,) in batch_iterator(len(images), crops):
+            cropped_ims = []
+            for image_idx, (x0, y0, x1, y1), _, _ in crops_chunk:
+                cropped_ims.append(images[image_idx][y0:y1, x0:x1, :])
+            features, input_sizes = self._encode_images(cropped_ims)
+
+            # Get points for every crop, remembering which crop they belong to
+            points_for_crops, owners = [], []
+            for crop_idx, (cropped_im, crop) in enumerate(zip(cropped_ims, crops_chunk)):
+                image_idx, crop_box, layer_idx, _ = crop
+                points_for_crops.append(
+                    self._points_for_crop(
+                        cropped_im.shape[:2], crop_box, layer_idx, valid_masks[image_idx]
+                    )
+                )
+                owners.append(np.full(len(points_for_crops[-1]), crop_idx))
+            points_for_crops = np.concatenate(points_for_crops, axis=0)
+            owners = np.concatenate(owners, axis=0)
+
+            # Generate masks for all crops in shared batches
+            chunk_datas = [MaskData() for _ in crops_chunk]
+            for points, points_owners in batch_iterator(
+                self.points_per_batch, points_for_crops, owners
+            ):
+                batch_datas = self._process_multi_crop_batch(
+                    points, points_owners, features, input_sizes, cropped_ims, crops_chunk
+                )
+                for crop_idx, batch_data in batch_datas:
+                    chunk_datas[crop_idx].cat(batch_data)
+                del batch_datas
+
+            for crop_data, (_, crop_box, _, _) in zip(chunk_datas, crops_chunk):
+                if len(crop_data.items()) == 0:
+                    # No valid point prompts in this crop
+                    crop_datas.append(self._empty_crop_data())
+                else:
+                    crop_datas.append(self._finalize_crop(crop_data, crop_box))
+            del features
+
+        # Gather crops back per image
+        mask_datas = []
+        for image_idx in range(len(images)):
+            data = MaskData()
+            crop_boxes = []
+            for crop_data, (crop_image_idx, crop_box, _, _) in zip(crop_datas, crops):
+                if crop_image_idx == image_idx:
+                    data.cat(crop_data)
+                    crop_boxes.append(crop_box)
+            mask_datas.append(self._merge_crops(data, crop_boxes))
+        return mask_datas
+
+    def _encode_images(
+        self, images: List[np.ndarray]
+    ) -> Tuple[torch.Tensor, List[Tuple[int, ...]]]:
+        # Transform every image like SamPredictor.set_image and stack them in one batch
+        model = self.predictor.model
+        input_images, input_sizes = [], []
+        for image in images:
+            input_image = self.predictor.transform.apply_image(image)
+            input_image_torch = torch.as_tensor(input_image, device=self.predictor.device)
+            input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()
+            input_sizes.append(tuple(input_image_torch.shape[-2:]))
+            input_images.append(model.preprocess(input_image_torch))
+        features = model.image_encoder(torch.stack(input_images, dim=0))
+        return features, input_sizes
+
+    def _merge_crops(self, data: MaskData, crop_boxes: List[List[int]]) -> MaskData:
         # Remove duplicate masks between crops
         if len(crop_boxes) > 1:
             # Prefer masks from smaller crops
@@ -228,16 +436,20 @@ class SamAutomaticMaskGenerator:
         crop_box: List[int],
         crop_layer_idx: int,
         orig_size: Tuple[int, ...],
+        valid_mask: Optional[np.ndarray] = None,
     ) -> MaskData:
-        # Crop the image and calculate embeddings
+        # Get points for this crop
         x0, y0, x1, y1 = crop_box
         cropped_im = image[y0:y1, x0:x1, :]
         cropped_im_size = cropped_im.shape[:2]
-        self.predictor.set_image(cropped_im)
+        points_for_image = self._points_for_crop(
+            cropped_im_size, crop_box, crop_layer_idx, valid_mask
+        )
+        if len(points_for_image) == 0:
+            return self._empty_crop_data()
 
-        # Get points for this crop
-        points_scale = np.array(cropped_im_size)[None, ::-1]
-        points_for_image = self.point_grids[crop_layer_idx] * points_scale
+        # Calculate embeddings
+        self.predictor.set_image(cropped_im)
 
         # Generate masks for this crop in batches
         data = MaskData()
@@ -247,6 +459,39 @@ class SamAutomaticMaskGenerator:
             del batch_data
         self.predictor.reset_image()
 
+        return self._finalize_crop(data, crop_box)
+
+    def _points_for_crop(
+        self,
+        cropped_im_size: Tuple[int, ...],
+        crop_box: List[int],
+        crop_layer_idx: int,
+        valid_mask: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        points_scale = np.array(cropped_im_size)[None, ::-1]
+        points_for_image = self.point_grids[crop_layer_idx] * points_scale
+        if valid_mask is not None:
+            # Drop points that fall on invalid pixels
+            x0, y0, x1, y1 = crop_box
+            crop_valid_mask = valid_mask[y0:y1, x0:x1]
+            xs = np.clip(points_for_image[:, 0].astype(int), 0, cropped_im_size[1] - 1)
+            ys = np.clip(points_for_image[:, 1].astype(int), 0, cropped_im_size[0] - 1)
+            points_for_image = points_for_image[crop_valid_mask[ys, xs]]
+        return points_for_image
+
+    def _empty_crop_data(self) -> MaskData:
+        # Masks are kept cut to their boxes for label maps, as RLEs otherwise
+        masks_key = "masks" if self.output_mode == "label_map" else "rles"
+        return MaskData(
+            **{masks_key: []},
+            boxes=torch.zeros((0, 4), dtype=torch.long),
+            iou_preds=torch.zeros(0),
+            points=torch.zeros((0, 2), dtype=torch.double),
+            stability_score=torch.zeros(0),
+            crop_boxes=torch.zeros((0, 4), dtype=torch.long),
+        )
+
+    def _finalize_crop(self, data: MaskData, crop_box: List[int]) -> MaskData:
         # Remove duplicates within this crop.
         keep_by_nms = batched_nms(
             data["boxes"].float(),
@@ -259,7 +504,9 @@ class SamAutomaticMaskGenerator:
         # Return to the original image frame
         data["boxes"] = uncrop_boxes_xyxy(data["boxes"], crop_box)
         data["points"] = uncrop_points(data["points"], crop_box)
-        data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data["rles"]))])
+        data["crop_boxes"] = torch.tensor(
+            [crop_box for _ in range(len(data["boxes"]))], dtype=torch.long
+        ).reshape(-1, 4)
 
         return data
 
@@ -270,18 +517,138 @@ class SamAutomaticMaskGenerator:
         crop_box: List[int],
         orig_size: Tuple[int, ...],
     ) -> MaskData:
-        orig_h, orig_w = orig_size
-
         # Run model on this batch
         transformed_points = self.predictor.transform.apply_coords(points, im_size)
         in_points = torch.as_tensor(transformed_points, device=self.predictor.device)
         in_labels = torch.ones(in_points.shape[0], dtype=torch.int, device=in_points.device)
-        masks, iou_preds, _ = self.predictor.predict_torch(
-            in_points[:, None, :],
-            in_labels[:, None],
-            multimask_output=True,
-            return_logits=True,
+        low_res_masks, iou_preds, prompt_idxs = self._decode_prompts(
+            in_points, in_labels, self.predictor.features
+        )
+        # Batches where no mask passes pred_iou_thresh go through with 0 rows,
+        # so they have the same keys, types and devices as the others
+        points = points[prompt_idxs]
+
+        if self.low_res_filtering:
+            return self._batch_to_mask_data(
+                low_res_masks, iou_preds, points, crop_box, orig_size, self.predictor.input_size
+            )
+        masks = self.predictor.model.postprocess_masks(
+            low_res_masks, self.predictor.input_size, self.predictor.original_size
+        )
+        return self._batch_to_mask_data(masks, iou_preds, points, crop_box, orig_size)
+
+    def _decode_prompts(
+        self, in_points: torch.Tensor, in_labels: torch.Tensor, image_embeddings: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor, np.ndarray]:
+        # Low resolution mask logits and IoU predictions for single point
+        # prompts, and the prompt of every row. With pred_iou_thresh > 0 the
+        # decoder runs in two phases: masks are synthesized only for the
+        # (prompt, mask) pairs whose predicted IoU passes, one pair per row.
+        # Otherwise rows are prompts with all their masks
+        model = self.predictor.model
+        sparse_embeddings, dense_embeddings = model.prompt_encoder(
+            points=(in_points[:, None, :], in_labels[:, None]),
+            boxes=None,
+            masks=None,
+        )
+        if self.pred_iou_thresh <= 0.0:
+            low_res_masks, iou_preds = model.mask_decoder(
+                image_embeddings=image_embeddings,
+                image_pe=model.prompt_encoder.get_dense_pe(),
+                sparse_prompt_embeddings=sparse_embeddings,
+                dense_prompt_embeddings=dense_embeddings,
+                multimask_output=True,
+            )
+            return low_res_masks, iou_preds, np.arange(len(in_points))
+
+        iou_preds, mask_tokens_out, src = model.mask_decoder.predict_iou(
+            image_embeddings=image_embeddings,
+            image_pe=model.prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+        )
+        # The multimask outputs, as with multimask_output=True
+        iou_preds = iou_preds[:, 1:]
+        prompt_idxs, token_idxs = torch.nonzero(iou_preds > self.pred_iou_thresh, as_tuple=True)
+        low_res_masks = model.mask_decoder.predict_selected_masks(
+            mask_tokens_out, src, prompt_idxs, token_idxs + 1
+        )
+        return (
+            low_res_masks[:, None],
+            iou_preds[prompt_idxs, token_idxs][:, None],
+            prompt_idxs.cpu().numpy(),
+        )
+
+    def _process_multi_crop_batch(
+        self,
+        points: np.ndarray,
+        owners: np.ndarray,
+        features: torch.Tensor,
+        input_sizes: List[Tuple[int, ...]],
+        cropped_ims: List[np.ndarray],
+        crops: List[Tuple[Any, ...]],
+    ) -> List[Tuple[int, MaskData]]:
+        model = self.predictor.model
+        crop_idxs = np.unique(owners)
+
+        # Transform points in the frame of the crop each one belongs to
+        transformed_points = np.empty(points.shape, dtype=float)
+        for crop_idx in crop_idxs:
+            in_crop = owners == crop_idx
+            transformed_points[in_crop] = self.predictor.transform.apply_coords(
+                points[in_crop], cropped_ims[crop_idx].shape[:2]
+            )
+        in_points = torch.as_tensor(transformed_points, device=self.predictor.device)
+        in_labels = torch.ones(in_points.shape[0], dtype=torch.int, device=in_points.device)
+
+        # Run the decoder once, pairing every prompt with its crop's embedding
+        low_res_masks, iou_preds, prompt_idxs = self._decode_prompts(
+            in_points, in_labels, features[torch.as_tensor(owners, device=features.device)]
         )
+        points, owners = points[prompt_idxs], owners[prompt_idxs]
+
+        # Split results back per crop
+        out = []
+        for crop_idx in np.unique(owners):
+            in_crop = owners == crop_idx
+            in_crop_torch = torch.as_tensor(in_crop, device=low_res_masks.device)
+            _, crop_box, _, orig_size = crops[crop_idx]
+            if self.low_res_filtering:
+                batch_data = self._batch_to_mask_data(
+                    low_res_masks[in_crop_torch],
+                    iou_preds[in_crop_torch],
+                    points[in_crop],
+                    crop_box,
+                    orig_size,
+                    input_sizes[crop_idx],
+                )
+            else:
+                masks = model.postprocess_masks(
+                    low_res_masks[in_crop_torch],
+                    input_sizes[crop_idx],
+                    cropped_ims[crop_idx].shape[:2],
+                )
+                batch_data = self._batch_to_mask_data(
+                    masks, iou_preds[in_crop_torch], points[in_crop], crop_box, orig_size
+                )
+            out.append((int(crop_idx), batch_data))
+        return out
+
+    def _batch_to_mask_data(
+        self,
+        masks: torch.Tensor,
+        iou_preds: torch.Tensor,
+        points: np.ndarray,
+        crop_box: List[int],
+        orig_size: Tuple[int, ...],
+        input_size: Optional[Tuple[int, ...]] = None,
+    ) -> MaskData:
+        # With input_size, masks are the low resolution logits of the decoder
+        # (low_res_filtering), otherwise logits of the crop size
+        orig_h, orig_w = orig_size
+        model = self.predictor.model
+        if input_size is not None:
+            masks = model.crop_low_res_masks(masks, input_size)
 
         # Serialize predictions and store in MaskData
         data = MaskData(
@@ -304,6 +671,13 @@ class SamAutomaticMaskGenerator:
             keep_mask = data["stability_score"] >= self.stability_score_thresh
             data.filter(keep_mask)
 
+        # Upscale the masks that are left straight to the crop size
+        if input_size is not None:
+            x0, y0, x1, y1 = crop_box
+            data["masks"] = model.upscale_low_res_masks(
+                data["masks"], input_size, (y1 - y0, x1 - x0)
+            )
+
         # Threshold masks and calculate boxes
         data["masks"] = data["masks"] > self.predictor.model.mask_threshold
         data["boxes"] = batched_mask_to_box(data["masks"])
@@ -313,6 +687,11 @@ class SamAutomaticMaskGenerator:
         if not torch.all(keep_mask):
             data.filter(keep_mask)
 
+        if self.output_mode == "label_map":
+            # Painted into the label map later, no need for full size masks
+            data["masks"] = crop_masks_to_boxes(data["masks"], data["boxes"])
+            return data
+
         # Compress to RLE
         data["masks"] = uncrop_masks(data["masks"], crop_box, orig_h, orig_w)
         data["rles"] = mask_to_rle_pytorch(data["masks"])
@@ -322,7 +701,10 @@ class SamAutomaticMaskGenerator:
 
     @staticmethod
     def postprocess_small_regions(
-        mask_data: MaskData, min_area: int, nms_thresh: float
+        mask_data: MaskData,
+        min_area: int,
+        nms_thresh: float,
+        orig_size: Optional[Tuple[int, ...]] = None,
     ) -> MaskData:
         """
         Removes small disconnected regions and holes in masks, then reruns
@@ -330,17 +712,21 @@ class SamAutomaticMaskGenerator:
 
         Edits mask_data in place.
 
-        Requires open-cv as a dependency.
+        Requires open-cv as a dependency. orig_size (H, W) is required for
+        masks cut to their boxes (output_mode='label_map').
         """
+        if "rles" not in mask_data:
+            assert orig_size is not None, "orig_size is required for label_map masks."
+            return SamAutomaticMaskGenerator._postprocess_small_regions_box_masks(
+                mask_data, min_area, nms_thresh, orig_size
+            )
         if len(mask_data["rles"]) == 0:
             return mask_data
 
         # Filter small disconnected regions and holes
         new_masks = []
         scores = []
-        for rle in mask_data["rles"]:
-            mask = rle_to_mask(rle)
-
+        for mask in rles_to_masks(mask_data["rles"]):
             mask, changed = remove_small_regions(mask, min_area, mode="holes")
             unchanged = not changed
             mask, changed = remove_small_regions(mask, min_area, mode="islands")
@@ -361,12 +747,63 @@ class SamAutomaticMaskGenerator:
             iou_threshold=nms_thresh,
         )
 
-        # Only recalculate RLEs for masks that have changed
-        for i_mask in keep_by_nms:
-            if scores[i_mask] == 0.0:
-                mask_torch = masks[i_mask].unsqueeze(0)
-                mask_data["rles"][i_mask] = mask_to_rle_pytorch(mask_torch)[0]
+        # Only recalculate RLEs for masks that have changed, in one batch
+        changed_idxs = [int(i) for i in keep_by_nms if scores[i] == 0.0]
+        if len(changed_idxs) > 0:
+            new_rles = mask_to_rle_pytorch(masks[changed_idxs])
+            for i_mask, rle in zip(changed_idxs, new_rles):
+                mask_data["rles"][i_mask] = rle
                 mask_data["boxes"][i_mask] = boxes[i_mask]  # update res directly
         mask_data.filter(keep_by_nms)
 
         return mask_data
+
+    @staticmethod
+    def _postprocess_small_regions_box_masks(
+        mask_data: MaskData, min_area: int, nms_thresh: float, orig_size: Tuple[int, ...]
+    ) -> MaskData:
+        # postprocess_small_regions for masks cut to their boxes (label_map)
+        if len(mask_data["masks"]) == 0:
+            return mask_data
+
+        # Box sides inside the image are padded, connecting background at them
+        # to a region of at least min_area pixels, so it is not taken for a
+        # hole, as in the full image. At the image edges nothing is padded
+        pad = int(np.ceil(np.sqrt(min_area)))
+        orig_h, orig_w = orig_size
+        new_masks = []
+        boxes = np.array(mask_data["boxes"])
+        scores = []
+        for i, mask in enumerate(mask_data["masks"]):
+            x0, y0, x1, y1 = boxes[i]
+            top, left = pad * (y0 > 0), pad * (x0 > 0)
+            bottom, right = pad * (y1 < orig_h - 1), pad * (x1 < orig_w - 1)
+            mask = np.pad(mask, ((top, bottom), (left, right)))
+
+            mask, changed = remove_small_regions(mask, min_area, mode="holes")
+            unchanged = not changed
+            mask, changed = remove_small_regions(mask, min_area, mode="islands")
+            unchanged = unchanged and not changed
+
+            # Cut back to the box of what is left
+            mask = mask[top : mask.shape[0] - bottom, left : mask.shape[1] - right]
+            rows = np.flatnonzero(mask.any(axis=1))
+            cols = np.flatnonzero(mask.any(axis=0))
+            if len(rows) > 0:
+                mask = mask[rows[0] : rows[-1] + 1, cols[0] : cols[-1] + 1]
+                boxes[i] = boxes[i, [0, 1, 0, 1]] + [cols[0], rows[0], cols[-1], rows[-1]]
+            new_masks.append(mask)
+            scores.append(float(unchanged))
+
+        # Remove any new duplicates
+        keep_by_nms = batched_nms(
+            torch.as_tensor(boxes).float(),
+            torch.as_tensor(scores),
+            torch.zeros(len(boxes)),  # categories
+            iou_threshold=nms_thresh,
+        )
+        mask_data["masks"] = new_masks
+        mask_data["boxes"] = boxes
+        mask_data.filter(keep_by_nms)
+
+        return mask_data
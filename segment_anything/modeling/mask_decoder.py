@@ -80,7 +80,8 @@ class MaskDecoder(nn.Module):
         Predict masks given image and prompt embeddings.
 
         Arguments:
-          image_embeddings (torch.Tensor): the embeddings from the image encoder
+          image_embeddings (torch.Tensor): the embeddings from the image encoder,
+            either a single image embedding or one embedding per prompt
           image_pe (torch.Tensor): positional encoding with the shape of image_embeddings
           sparse_prompt_embeddings (torch.Tensor): the embeddings of the points and boxes
           dense_prompt_embeddings (torch.Tensor): the embeddings of the mask inputs
@@ -117,13 +118,54 @@ class MaskDecoder(nn.Module):
         dense_prompt_embeddings: torch.Tensor,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Predicts masks. See 'forward' for more details."""
+        iou_pred, mask_tokens_out, src = self.predict_iou(
+            image_embeddings=image_embeddings,
+            image_pe=image_pe,
+            sparse_prompt_embeddings=sparse_prompt_embeddings,
+            dense_prompt_embeddings=dense_prompt_embeddings,
+        )
+
+        # Upscale mask embeddings and predict masks using the mask tokens
+        upscaled_embedding = self.output_upscaling(src)
+        hyper_in_list: List[torch.Tensor] = []
+        for i in range(self.num_mask_tokens):
+            hyper_in_list.append(self.output_hypernetworks_mlps[i](mask_tokens_out[:, i, :]))
+        hyper_in = torch.stack(hyper_in_list, dim=1)
+        b, c, h, w = upscaled_embedding.shape
+        masks = (hyper_in @ upscaled_embedding.view(b, c, h * w)).view(b, -1, h, w)
+
+        return masks, iou_pred
+
+    def predict_iou(
+        self,
+        image_embeddings: torch.Tensor,
+        image_pe: torch.Tensor,
+        sparse_prompt_embeddings: torch.Tensor,
+        dense_prompt_embeddings: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Runs the transformer and predicts mask quality without synthesizing
+        masks, the first phase of a two-phase prediction. Masks are then
+        synthesized for chosen prompts and mask tokens by
+        'predict_selected_masks'. See 'forward' for the arguments.
+
+        Returns:
+          torch.Tensor: batched predictions of mask quality, for all mask tokens
+          torch.Tensor: the mask token outputs of the transformer, in BxNxC format
+          torch.Tensor: the image embedding outputs of the transformer, in
+            BxCxHxW format
+        """
         # Concatenate output tokens
         output_tokens = torch.cat([self.iou_token.weight, self.mask_tokens.weight], dim=0)
         output_tokens = output_tokens.unsqueeze(0).expand(sparse_prompt_embeddings.size(0), -1, -1)
         tokens = torch.cat((output_tokens, sparse_prompt_embeddings), dim=1)
 
-        # Expand per-image data in batch direction to be per-mask
-        src = torch.repeat_interleave(image_embeddings, tokens.shape[0], dim=0)
+        # Expand per-image data in batch direction to be per-mask. If one
+        # embedding per prompt is given (prompts from several images), use it as is.
+        if image_embeddings.shape[0] == tokens.shape[0]:
+            src = image_embeddings
+        else:
+            src = torch.repeat_interleave(image_embeddings, tokens.shape[0], dim=0)
         src = src + dense_prompt_embeddings
         pos_src = torch.repeat_interleave(image_pe, tokens.shape[0], dim=0)
         b, c, h, w = src.shape
@@ -132,21 +174,56 @@ class MaskDecoder(nn.Module):
         hs, src = self.transformer(src, pos_src, tokens)
         iou_token_out = hs[:, 0, :]
         mask_tokens_out = hs[:, 1 : (1 + self.num_mask_tokens), :]
-
-        # Upscale mask embeddings and predict masks using the mask tokens
         src = src.transpose(1, 2).view(b, c, h, w)
-        upscaled_embedding = self.output_upscaling(src)
-        hyper_in_list: List[torch.Tensor] = []
-        for i in range(self.num_mask_tokens):
-            hyper_in_list.append(self.output_hypernetworks_mlps[i](mask_tokens_out[:, i, :]))
-        hyper_in = torch.stack(hyper_in_list, dim=1)
-        b, c, h, w = upscaled_embedding.shape
-        masks = (hyper_in @ upscaled_embedding.view(b, c, h * w)).view(b, -1, h, w)
 
         # Generate mask quality predictions
         iou_pred = self.iou_prediction_head(iou_token_out)
 
-        return masks, iou_pred
+        return iou_pred, mask_tokens_out, src
+
+    def predict_selected_masks(
+        self,
+        mask_tokens_out: torch.Tensor,
+        src: torch.Tensor,
+        prompt_idxs: torch.Tensor,
+        token_idxs: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        Synthesizes masks for the selected (prompt, mask token) pairs only,
+        the second phase of a two-phase prediction. Mask embeddings are
+        upscaled only for prompts with a selected pair, and the hypernetwork
+        MLPs run only on the selected mask tokens.
+
+        Arguments:
+          mask_tokens_out (torch.Tensor): the mask token outputs of 'predict_iou'
+          src (torch.Tensor): the image embedding outputs of 'predict_iou'
+          prompt_idxs (torch.Tensor): the prompt index of every selected pair
+          token_idxs (torch.Tensor): the mask token index of every selected
+            pair. Index 0 is the single mask output, the multimask outputs
+            start at 1.
+
+        Returns:
+          torch.Tensor: the masks of the selected pairs, in Kx(4H)x(4W) format
+        """
+        _, c, h, w = src.shape
+        if len(prompt_idxs) == 0:
+            return src.new_zeros(0, 4 * h, 4 * w)
+        prompts, pair_prompts = torch.unique(prompt_idxs, return_inverse=True)
+
+        # Upscale the mask embeddings of the prompts with a selected pair
+        upscaled_embedding = self.output_upscaling(src[prompts])
+        u, c, h, w = upscaled_embedding.shape
+
+        # Hypernetwork outputs of the selected pairs, zero for the others
+        hyper_in = upscaled_embedding.new_zeros(u, self.num_mask_tokens, c)
+        for i in range(self.num_mask_tokens):
+            selected = token_idxs == i
+            if selected.any():
+                hyper_in[pair_prompts[selected], i] = self.output_hypernetworks_mlps[i](
+                    mask_tokens_out[prompt_idxs[selected], i, :]
+                )
+        masks = (hyper_in @ upscaled_embedding.view(u, c, h * w)).view(u, -1, h, w)
+        return masks[pair_prompts, token_idxs]
 
 
 # Lightly adapted from
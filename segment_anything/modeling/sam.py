@@ -4,6 +4,8 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import math
+
 import torch
 from torch import nn
 from torch.nn import functional as F
@@ -161,6 +163,63 @@ class Sam(nn.Module):
         masks = F.interpolate(masks, original_size, mode="bilinear", align_corners=False)
         return masks
 
+    def crop_low_res_masks(
+        self, masks: torch.Tensor, input_size: Tuple[int, ...]
+    ) -> torch.Tensor:
+        """
+        Remove padding from low resolution masks, keeping the low resolution
+        pixels that overlap the input image.
+
+        Arguments:
+          masks (torch.Tensor): Masks from the mask_decoder, in ...xHxW format.
+          input_size (tuple(int, int)): The size of the image input to the
+            model, in (H, W) format.
+
+        Returns:
+          (torch.Tensor): The masks in ...xhxw format, where (h, w) is
+            input_size divided by the mask downscaling factor, rounded up.
+        """
+        scale = self.image_encoder.img_size / self.prompt_encoder.mask_input_size[0]
+        return masks[..., : math.ceil(input_size[0] / scale), : math.ceil(input_size[1] / scale)]
+
+    def upscale_low_res_masks(
+        self,
+        masks: torch.Tensor,
+        input_size: Tuple[int, ...],
+        original_size: Tuple[int, ...],
+    ) -> torch.Tensor:
+        """
+        Upscale low resolution masks cropped by crop_low_res_masks to the
+        original image size in a single interpolation. postprocess_masks
+        interpolates twice, through the padded input size, so the results
+        are close but not identical.
+
+        Arguments:
+          masks (torch.Tensor): Cropped low resolution masks, in ...xhxw format.
+          input_size (tuple(int, int)): The size of the image input to the
+            model, in (H, W) format.
+          original_size (tuple(int, int)): The original size of the image
+            before resizing for input to the model, in (H, W) format.
+
+        Returns:
+          (torch.Tensor): The masks in ...xHxW format, where (H, W) is given
+            by original_size.
+        """
+        scale = self.image_encoder.img_size / self.prompt_encoder.mask_input_size[0]
+        h, w = masks.shape[-2:]
+        out_size = (
+            round(h * scale * original_size[0] / input_size[0]),
+            round(w * scale * original_size[1] / input_size[1]),
+        )
+        leading = masks.shape[:-2]
+        if masks.numel() == 0:
+            return masks.new_zeros(*leading, *original_size)
+        masks = F.interpolate(
+            masks.reshape(-1, 1, h, w), out_size, mode="bilinear", align_corners=False
+        )
+        masks = masks[:, 0, : original_size[0], : original_size[1]]
+        return masks.reshape(*leading, *original_size)
+
     def preprocess(self, x: torch.Tensor) -> torch.Tensor:
         """Normalize pixel values and pad to a square input."""
         # Normalize colors
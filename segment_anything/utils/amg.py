@@ -16,7 +16,10 @@ from typing import Any, Dict, Generator, ItemsView, List, Tuple
 class MaskData:
     """
     A structure for storing masks and their related data in batched format.
-    Implements basic filtering and concatenation.
+    Implements basic filtering and concatenation. Tensors and arrays added
+    by 'cat' are kept as chunks and joined once when the key is read, lists
+    are extended in place, so accumulating many batches costs linear time.
+    'cat' takes the values of the added MaskData without copying them.
     """
 
     def __init__(self, **kwargs) -> None:
@@ -24,53 +27,70 @@ class MaskData:
             assert isinstance(
                 v, (list, np.ndarray, torch.Tensor)
             ), "MaskData only supports list, numpy arrays, and torch tensors."
-        self._stats = dict(**kwargs)
+        self._stats = {k: list(v) if isinstance(v, list) else v for k, v in kwargs.items()}
+        self._chunks: Dict[str, List[Any]] = {}
 
     def __setitem__(self, key: str, item: Any) -> None:
         assert isinstance(
             item, (list, np.ndarray, torch.Tensor)
         ), "MaskData only supports list, numpy arrays, and torch tensors."
-        self._stats[key] = item
+        self._chunks.pop(key, None)
+        self._stats[key] = list(item) if isinstance(item, list) else item
 
     def __delitem__(self, key: str) -> None:
+        self._chunks.pop(key, None)
         del self._stats[key]
 
     def __getitem__(self, key: str) -> Any:
+        self._join(key)
         return self._stats[key]
 
+    def __contains__(self, key: str) -> bool:
+        return key in self._stats
+
     def items(self) -> ItemsView[str, Any]:
+        for k in list(self._chunks):
+            self._join(k)
         return self._stats.items()
 
+    def _join(self, key: str) -> None:
+        chunks = self._chunks.pop(key, None)
+        if chunks is None:
+            return
+        v = self._stats[key]
+        if isinstance(v, torch.Tensor):
+            self._stats[key] = torch.cat([v] + chunks, dim=0)
+        else:
+            self._stats[key] = np.concatenate([v] + chunks, axis=0)
+
     def filter(self, keep: torch.Tensor) -> None:
-        for k, v in self._stats.items():
+        keep_np = torch.as_tensor(keep).detach().cpu().numpy()
+        idxs = np.flatnonzero(keep_np) if keep_np.dtype == bool else keep_np.reshape(-1)
+        for k, v in self.items():
             if v is None:
                 self._stats[k] = None
             elif isinstance(v, torch.Tensor):
                 self._stats[k] = v[torch.as_tensor(keep, device=v.device)]
             elif isinstance(v, np.ndarray):
-                self._stats[k] = v[keep.detach().cpu().numpy()]
-            elif isinstance(v, list) and keep.dtype == torch.bool:
-                self._stats[k] = [a for i, a in enumerate(v) if keep[i]]
+                self._stats[k] = v[keep_np]
             elif isinstance(v, list):
-                self._stats[k] = [v[i] for i in keep]
+                self._stats[k] = [v[i] for i in idxs.tolist()]
             else:
                 raise TypeError(f"MaskData key {k} has an unsupported type {type(v)}.")
 
     def cat(self, new_stats: "MaskData") -> None:
         for k, v in new_stats.items():
             if k not in self._stats or self._stats[k] is None:
-                self._stats[k] = deepcopy(v)
-            elif isinstance(v, torch.Tensor):
-                self._stats[k] = torch.cat([self._stats[k], v], dim=0)
-            elif isinstance(v, np.ndarray):
-                self._stats[k] = np.concatenate([self._stats[k], v], axis=0)
+                self._stats[k] = list(v) if isinstance(v, list) else v
+            elif isinstance(v, (torch.Tensor, np.ndarray)):
+                self._chunks.setdefault(k, []).append(v)
             elif isinstance(v, list):
-                self._stats[k] = self._stats[k] + deepcopy(v)
+                self._stats[k].extend(v)
             else:
                 raise TypeError(f"MaskData key {k} has an unsupported type {type(v)}.")
 
     def to_numpy(self) -> None:
-        for k, v in self._stats.items():
+        for k, v in self.items():
             if isinstance(v, torch.Tensor):
                 self._stats[k] = v.detach().cpu().numpy()
 
@@ -113,38 +133,62 @@ def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
     b, h, w = tensor.shape
     tensor = tensor.permute(0, 2, 1).flatten(1)
 
-    # Compute change indices
+    # Compute change indices, sorted by mask and position
     diff = tensor[:, 1:] ^ tensor[:, :-1]
-    change_indices = diff.nonzero()
-
-    # Encode run length
+    change_indices = diff.nonzero().cpu().numpy()
+    starts_with_one = (tensor[:, 0] != 0).cpu().numpy()
+
+    # Run boundaries of all masks in one array: 0, the change indices + 1
+    # and h * w for every mask
+    n_changes = np.bincount(change_indices[:, 0], minlength=b)
+    ends = np.cumsum(n_changes + 2)
+    bounds = np.zeros(ends[-1] if b > 0 else 0, dtype=np.int64)
+    bounds[ends - 1] = h * w
+    bounds[np.arange(len(change_indices)) + 2 * change_indices[:, 0] + 1] = change_indices[:, 1] + 1
+
+    # Run lengths, the differences between the masks are not runs
+    lengths = np.diff(bounds).tolist()
     out = []
+    start = 0
     for i in range(b):
-        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
-        cur_idxs = torch.cat(
-            [
-                torch.tensor([0], dtype=cur_idxs.dtype, device=cur_idxs.device),
-                cur_idxs + 1,
-                torch.tensor([h * w], dtype=cur_idxs.dtype, device=cur_idxs.device),
-            ]
-        )
-        btw_idxs = cur_idxs[1:] - cur_idxs[:-1]
-        counts = [] if tensor[i, 0] == 0 else [0]
-        counts.extend(btw_idxs.detach().cpu().tolist())
+        counts = [0] if starts_with_one[i] else []
+        counts.extend(lengths[start : ends[i] - 1])
+        start = ends[i]
         out.append({"size": [h, w], "counts": counts})
     return out
 
 
+def _flat_counts(rles: List[Dict[str, Any]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Counts of all RLEs in one array, the RLE each belongs to and whether it
+    # is a run of ones (odd position within its RLE)
+    n_counts = np.array([len(rle["counts"]) for rle in rles], dtype=np.int64)
+    counts = np.fromiter(
+        (c for rle in rles for c in rle["counts"]), dtype=np.int64, count=int(n_counts.sum())
+    )
+    owners = np.repeat(np.arange(len(rles)), n_counts)
+    offsets = np.cumsum(n_counts) - n_counts
+    ones = (np.arange(len(counts)) - offsets[owners]) % 2 == 1
+    return counts, owners, ones
+
+
+def rles_to_masks(rles: List[Dict[str, Any]]) -> np.ndarray:
+    """
+    Computes binary masks from uncompressed RLEs of the same size, as a
+    BxHxW array.
+    """
+    if len(rles) == 0:
+        return np.zeros((0, 0, 0), dtype=bool)
+    h, w = rles[0]["size"]
+    counts, _, ones = _flat_counts(rles)
+    masks = np.repeat(ones, counts).reshape(len(rles), w, h)
+    return masks.transpose(0, 2, 1)  # Put in C order
+
+
 def rle_to_mask(rle: Dict[str, Any]) -> np.ndarray:
     """Compute a binary mask from an uncompressed RLE."""
     h, w = rle["size"]
-    mask = np.empty(h * w, dtype=bool)
-    idx = 0
-    parity = False
-    for count in rle["counts"]:
-        mask[idx : idx + count] = parity
-        idx += count
-        parity ^= True
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    mask = np.repeat(np.arange(len(counts)) % 2 == 1, counts)
     mask = mask.reshape(w, h)
     return mask.transpose()  # Put in C order
 
@@ -153,6 +197,12 @@ def area_from_rle(rle: Dict[str, Any]) -> int:
     return sum(rle["counts"][1::2])
 
 
+def areas_from_rles(rles: List[Dict[str, Any]]) -> np.ndarray:
+    """Computes the areas of uncompressed RLEs."""
+    counts, owners, ones = _flat_counts(rles)
+    return np.bincount(owners[ones], weights=counts[ones], minlength=len(rles)).astype(np.int64)
+
+
 def calculate_stability_score(
     masks: torch.Tensor, mask_threshold: float, threshold_offset: float
 ) -> torch.Tensor:
@@ -264,6 +314,34 @@ def uncrop_masks(
     return torch.nn.functional.pad(masks, pad, value=0)
 
 
+def crop_masks_to_boxes(masks: torch.Tensor, boxes: torch.Tensor) -> List[np.ndarray]:
+    """
+    Cuts every mask in a Bx(HxW) tensor to its XYXY box, as computed by
+    batched_mask_to_box (inclusive corners). Returns a list of numpy arrays.
+    """
+    masks_np = masks.cpu().numpy()
+    boxes_np = boxes.cpu().numpy()
+    return [
+        mask[y0 : y1 + 1, x0 : x1 + 1].copy()
+        for mask, (x0, y0, x1, y1) in zip(masks_np, boxes_np)
+    ]
+
+
+def paint_label_map(
+    box_masks: List[np.ndarray], boxes: np.ndarray, orig_size: Tuple[int, ...]
+) -> np.ndarray:
+    """
+    Paints masks cut to their XYXY boxes into an int32 label map, where the
+    i-th mask has the id i + 1 and 0 is the background. Masks are painted
+    from the last to the first, so earlier masks win where masks overlap.
+    """
+    label_map = np.zeros(orig_size, dtype=np.int32)
+    for i in range(len(box_masks) - 1, -1, -1):
+        x0, y0, x1, y1 = (int(v) for v in boxes[i])
+        label_map[y0 : y1 + 1, x0 : x1 + 1][box_masks[i]] = i + 1
+    return label_map
+
+
 def remove_small_regions(
     mask: np.ndarray, area_thresh: float, mode: str
 ) -> Tuple[np.ndarray, bool]:
@@ -300,6 +378,19 @@ def coco_encode_rle(uncompressed_rle: Dict[str, Any]) -> Dict[str, Any]:
     return rle
 
 
+def coco_encode_rles(uncompressed_rles: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Compresses uncompressed RLEs of the same size in one pycocotools call."""
+    from pycocotools import mask as mask_utils  # type: ignore
+
+    if len(uncompressed_rles) == 0:
+        return []
+    h, w = uncompressed_rles[0]["size"]
+    rles = mask_utils.frPyObjects(uncompressed_rles, h, w)
+    for rle in rles:
+        rle["counts"] = rle["counts"].decode("utf-8")  # Necessary to serialize with json
+    return rles
+
+
 def batched_mask_to_box(masks: torch.Tensor) -> torch.Tensor:
     """
     Calculates boxes in XYXY format around masks. Return [0,0,0,0] for
@@ -1,9 +1,25 @@
+import inspect
+import os
+import queue
 import tempfile
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
 import rasterio
+import rasterio.shutil
+from rasterio.enums import MaskFlags
+import torch
 from tqdm import tqdm
 
+from aoi import AoiClipper, load_aoi, prune_sample_grid, to_pixels
+from block_reader import CachedBlockReader, order_sample_grid
+from journal import JobJournal
+from mosaic import open_source
+import metrics
+from stitching import InstanceStitcher, relabel_array, relabel_raster
+
 
 def chw_to_hwc(block):
     # Grab first 3 channels
@@ -19,52 +35,604 @@ def hwc_to_hw(block, channel=0):
     block = block[..., channel].astype(np.uint8)
     return block
 
-def calculate_sample_grid(raster_h, raster_w, sample_h, sample_w, bound):
+class SampleGrid:
+    # Sample blocks kept as an (n, 2) array of (y, x) origins, indexing and
+    # iterating give the block dicts ({'x', 'y', 'height', 'width', 'bounds'})
+
+    def __init__(self, raster_h, raster_w, sample_h, sample_w, bound, origins=None):
+        self.raster_h, self.raster_w = raster_h, raster_w
+        self.sample_h, self.sample_w = sample_h, sample_w
+        self.bound = bound
+        if origins is None:
+            ys = np.arange(-bound, raster_h, sample_h, dtype=np.int32)
+            xs = np.arange(-bound, raster_w, sample_w, dtype=np.int32)
+            origins = np.stack(np.meshgrid(ys, xs, indexing='ij'), axis=-1).reshape(-1, 2)
+        self.origins = origins
+
+    def __len__(self):
+        return len(self.origins)
+
+    def __getitem__(self, idx):
+        y, x = (int(v) for v in self.origins[idx])
+        bound = self.bound
+        height = self.sample_h + 2 * bound
+        width = self.sample_w + 2 * bound
+
+        rigth_x_bound = max(bound,
+                            x + width - self.raster_w)
+        bottom_y_bound = max(bound,
+                            y + height - self.raster_h)
+
+        return {'x': x,
+                'y': y,
+                'height': height,
+                'width': width,
+                'bounds':
+                    [[bound, bottom_y_bound], [bound, rigth_x_bound]],
+                }
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
 
-    h, w = sample_h, sample_w
-    blocks = []
-    height = h + 2 * bound
-    width = w + 2 * bound
+    def take(self, indices):
+        # Sub grid of the blocks at indices (or a boolean mask), in that order
+        return SampleGrid(self.raster_h, self.raster_w, self.sample_h, self.sample_w, self.bound,
+                          self.origins[indices])
 
-    for y in range(- bound, raster_h, h):
-        for x in range(- bound, raster_w, w):
+    def extents(self):
+        # (n, 4) array of y0, y1, x0, x1 of the written (cropped) block areas
+        y0 = np.minimum(self.origins[:, 0].astype(np.int64) + self.bound, self.raster_h)
+        x0 = np.minimum(self.origins[:, 1].astype(np.int64) + self.bound, self.raster_w)
+        return np.stack([y0, np.minimum(y0 + self.sample_h, self.raster_h),
+                         x0, np.minimum(x0 + self.sample_w, self.raster_w)], axis=1)
 
-            rigth_x_bound = max(bound,
-                                x + width - raster_w)
-            bottom_y_bound = max(bound,
-                                y + height - raster_h)
 
-            blocks.append({'x': x,
-                           'y': y,
-                           'height': height,
-                           'width': width,
-                           'bounds':
-                               [[bound, bottom_y_bound], [bound, rigth_x_bound]],
-                           })
-    return blocks
+def calculate_sample_grid(raster_h, raster_w, sample_h, sample_w, bound):
+    return SampleGrid(raster_h, raster_w, sample_h, sample_w, bound)
 
 
 def read_block(src, x, y, height, width, nodata=0, **kwargs):
     return src.read(window=((y, y + height), (x, x + width)), boundless=True, fill_value=nodata)
 
 
-def write_block(dst, raster, y, x, height, width, bounds=None):
+def read_valid_mask(src, block, x, y, height, width, **kwargs):
+    # Pixels outside the raster are invalid, inside it the dataset mask decides
+    valid = np.zeros((height, width), dtype=bool)
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + width, src.width), min(y + height, src.height)
+    if x1 <= x0 or y1 <= y0:
+        return valid
+
+    inside = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+    flags = src.mask_flag_enums
+    if all(MaskFlags.all_valid in f for f in flags):
+        valid[inside] = True
+    elif all(MaskFlags.nodata in f for f in flags):
+        # Nodata masks can be computed from the pixels that are already read,
+        # a pixel is invalid when every band holds its nodata value
+        in_block = block[(slice(None),) + inside]
+        valid[inside] = np.any([band != nodata for band, nodata in zip(in_block, src.nodatavals)], axis=0)
+    else:
+        valid[inside] = src.dataset_mask(window=((y0, y1), (x0, x1))) > 0
+    return valid
+
+
+def overview_valid_mask(src, max_side=1024):
+    # Coarse validity map read from the overviews, None if it can't be read cheaply
+    if all(MaskFlags.all_valid in f for f in src.mask_flag_enums):
+        return None, None
+    factors = src.overviews(1)
+    if not factors:
+        return None, None
+
+    needed = max(src.height, src.width) / max_side
+    factor = min([f for f in factors if f >= needed], default=max(factors))
+    out_shape = (-(-src.height // factor), -(-src.width // factor))
+    return src.dataset_mask(out_shape=out_shape) > 0, factor
+
+
+def is_block_empty(coarse_valid, factor, x, y, height, width, **kwargs):
+    # Grow the coarse window by a pixel, so thin valid areas are not lost to decimation
+    ch, cw = coarse_valid.shape
+    y0, x0 = max(y // factor - 1, 0), max(x // factor - 1, 0)
+    y1, x1 = min(-(-(y + height) // factor) + 1, ch), min(-(-(x + width) // factor) + 1, cw)
+    return not coarse_valid[y0:y1, x0:x1].any()
+
+
+def block_readers(src, skip_invalid=False, aligned_reads=True, window_height=768):
+    # read(b) -> CHW block, or None when the block is known to hold no valid data
+    # read_valid(b, block) -> HW bool mask of valid pixels
+    if aligned_reads:
+        read_window = CachedBlockReader(src, window_height).read
+    else:
+        read_window = lambda **b: read_block(src, **b)
+
+    if not skip_invalid:
+        return (lambda b: read_window(**b)), None
+
+    coarse_valid, factor = overview_valid_mask(src)
+
+    def read(b):
+        if coarse_valid is not None and is_block_empty(coarse_valid, factor, **b):
+            return None
+        return read_window(**b)
+
+    def read_valid(b, block):
+        return read_valid_mask(src, block, **b)
+
+    return read, read_valid
+
+
+def crop_block(raster, y, x, height, width, bounds=None):
     if bounds:
         raster = raster[bounds[0][0]:raster.shape[0]-bounds[0][1], bounds[1][0]:raster.shape[1]-bounds[1][1]]
         x += bounds[1][0]
         y += bounds[0][0]
         width = width - bounds[1][1] - bounds[1][0]
         height = height - bounds[0][1] - bounds[0][0]
+    return raster, y, x, height, width
+
+
+def write_block(dst, raster, y, x, height, width, bounds=None):
+    raster, y, x, height, width = crop_block(raster, y, x, height, width, bounds)
     dst.write(raster, 1, window=((y, y+height), (x, x+width)))
 
 
+def read_array_block(array, x, y, height, width, nodata=0, **kwargs):
+    # In-memory read_block for a CHW array
+    c, rh, rw = array.shape
+    block = np.full((c, height, width), nodata, dtype=array.dtype)
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + width, rw), min(y + height, rh)
+    if x1 > x0 and y1 > y0:
+        block[:, y0 - y:y1 - y, x0 - x:x1 - x] = array[:, y0:y1, x0:x1]
+    return block
+
+
+def write_array_block(array, raster, y, x, height, width, bounds=None):
+    # In-memory write_block for a HW array
+    raster, y, x, height, width = crop_block(raster, y, x, height, width, bounds)
+    array[y:y+height, x:x+width] = raster
+
+
+class BlockWriter:
+    # Writes sample blocks to dst_fp. With a journal, the dataset is flushed every
+    # checkpoint_every blocks and only flushed blocks are recorded as done
+
+    def __init__(self, dst_fp, profile, journal=None, checkpoint_every=64, update=False):
+        self.dst_fp = dst_fp
+        self.journal = journal
+        self.checkpoint_every = checkpoint_every
+        self.pending = []
+        if update:
+            self.dst = rasterio.open(dst_fp, 'r+')
+        else:
+            self.dst = rasterio.open(dst_fp, 'w', **profile)
+
+    def write(self, b, raster):
+        write_block(self.dst, raster, **b)
+        if self.journal is not None:
+            self.pending.append((b['y'], b['x']))
+            if len(self.pending) >= self.checkpoint_every:
+                self.checkpoint()
+
+    def checkpoint(self):
+        # Closing is the only way to make GDAL flush its block cache to disk
+        self.dst.close()
+        self.journal.mark_done(self.pending)
+        self.pending = []
+        self.dst = rasterio.open(self.dst_fp, 'r+')
+
+    def close(self):
+        self.dst.close()
+        if self.journal is not None:
+            self.journal.mark_done(self.pending)
+            self.pending = []
+            self.journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BufferedBlockWriter:
+    # Collects sample blocks in full-width bands of output tiles and writes
+    # every band once, when all of its pixels arrived. Writes always match the
+    # internal tiling, so compressed tiles are never read back and rewritten,
+    # and GDAL compresses the tiles of a band on num_threads threads.
+    # With a sample_grid covering only part of the raster, bands are complete
+    # once the pixels of its blocks arrived
+
+    def __init__(self, dst_fp, profile, block_size=512, num_threads='ALL_CPUS', sample_grid=None):
+        profile = dict(profile, tiled=True, blockxsize=block_size, blockysize=block_size,
+                       num_threads=num_threads)
+        profile.pop('interleave', None)
+        self.dst = rasterio.open(dst_fp, 'w', **profile)
+        self.band_h = block_size
+        self.bands = {}
+        self.expected = None
+        if sample_grid is not None:
+            self.expected = self.band_pixels(sample_grid)
+
+    def band_pixels(self, sample_grid):
+        # Pixels every band gets from the grid, summed over rows of the written areas
+        y0, y1, x0, x1 = sample_grid.extents().T
+        rows = np.zeros(self.dst.height + 1, dtype=np.int64)
+        np.add.at(rows, y0, x1 - x0)
+        np.add.at(rows, y1, -(x1 - x0))
+        rows = np.cumsum(rows)[:-1]
+        bands = -(-self.dst.height // self.band_h)
+        rows = np.pad(rows, (0, bands * self.band_h - len(rows)))
+        return rows.reshape(bands, self.band_h).sum(axis=1)
+
+    def write(self, b, raster):
+        raster, y, x, height, width = crop_block(raster, **b)
+        # Edge grid blocks can be empty, they must not reopen flushed bands
+        if height <= 0 or width <= 0:
+            return
+        dst, band_h = self.dst, self.band_h
+        for band in range(y // band_h, (y + height - 1) // band_h + 1):
+            by0 = band * band_h
+            by1 = min(by0 + band_h, dst.height)
+            if band not in self.bands:
+                self.bands[band] = [np.zeros((by1 - by0, dst.width), dtype=dst.dtypes[0]), 0]
+            buffer = self.bands[band]
+
+            iy0, iy1 = max(y, by0), min(y + height, by1)
+            buffer[0][iy0 - by0:iy1 - by0, x:x + width] = raster[iy0 - y:iy1 - y]
+            buffer[1] += (iy1 - iy0) * width
+            expected = buffer[0].size if self.expected is None else self.expected[band]
+            if buffer[1] >= expected:
+                self.flush(band)
+
+    def flush(self, band):
+        array, _ = self.bands.pop(band)
+        by0 = band * self.band_h
+        self.dst.write(array, 1, window=((by0, by0 + array.shape[0]), (0, array.shape[1])))
+
+    def close(self):
+        # Bands the grid did not fully cover (e.g. after an error) are written as they are
+        for band in sorted(self.bands):
+            self.flush(band)
+        self.dst.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_cog(src_fp, dst_fp, block_size=512, num_threads='ALL_CPUS'):
+    # The COG driver builds the overviews while copying, nearest resampling
+    # keeps class values and instance ids intact
+    with rasterio.open(src_fp) as src:
+        compress = src.profile.get('compress') or 'deflate'
+    rasterio.shutil.copy(src_fp, dst_fp, driver='COG',
+                         blocksize=block_size,
+                         compress=compress,
+                         num_threads=num_threads,
+                         overview_resampling='nearest')
+
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def takes_argument(func, name):
+    try:
+        return name in inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def call_batch(func, images, valid_masks=None):
+    # Tile-batch protocol: func may implement batch_call(list_of_images) -> list_of_outputs.
+    # Valid pixel masks are passed to callables that take them (valid_mask / valid_masks)
+    if len(images) > 1 and hasattr(func, 'batch_call'):
+        if valid_masks is not None and takes_argument(func.batch_call, 'valid_masks'):
+            return func.batch_call(images, valid_masks=valid_masks)
+        return func.batch_call(images)
+    if valid_masks is not None and takes_argument(func, 'valid_mask'):
+        return [func(image, valid_mask=valid_mask) for image, valid_mask in zip(images, valid_masks)]
+    return [func(image) for image in images]
+
+
+_STOP = object()
+
+
+def threaded(iterable, maxsize):
+    # Run iterable on its own thread, handing items over through a bounded queue
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+                if stop.is_set():
+                    return
+            items.put((_STOP, None))
+        except BaseException as e:
+            items.put((_STOP, e))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _STOP:
+                break
+            yield item
+    finally:
+        # Unblock the producer if the consumer stopped early
+        stop.set()
+        while thread.is_alive():
+            try:
+                items.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
+
+
+def read_stage(sample_grid, read, data_to_rgb=chw_to_hwc, resize_hw=None, read_valid=None):
+    for b in sample_grid:
+        with metrics.timer('read', b['height'] * b['width']):
+            r = read(b)
+
+            # Blocks without valid pixels skip inference
+            valid_mask = read_valid(b, r) if r is not None and read_valid is not None else None
+        if r is None or (valid_mask is not None and not valid_mask.any()):
+            yield b, None, None, None
+            continue
+        if valid_mask is not None and valid_mask.all():
+            valid_mask = None
+
+        with metrics.timer('to_rgb', b['height'] * b['width']):
+            uint8_rgb_in = data_to_rgb(r)
+            orig_size = uint8_rgb_in.shape[:2]
+            if resize_hw is not None:
+                uint8_rgb_in = cv2.resize(uint8_rgb_in, resize_hw, interpolation=cv2.INTER_LINEAR)
+        yield b, uint8_rgb_in, orig_size, valid_mask
+
+
+def infer_stage(blocks, func, resize_hw=None, batch_size=1):
+    for batch in iter_batches(blocks, batch_size):
+        to_infer = [item for item in batch if item[1] is not None]
+        uint8_rgb_ins = [uint8_rgb_in for _, uint8_rgb_in, _, _ in to_infer]
+        valid_masks = [valid_mask for _, _, _, valid_mask in to_infer]
+        if all(valid_mask is None for valid_mask in valid_masks):
+            valid_masks = None
+        elif resize_hw is not None:
+            valid_masks = [None if m is None else cv2.resize(m.astype(np.uint8), resize_hw, interpolation=cv2.INTER_NEAREST) > 0
+                           for m in valid_masks]
+
+        # Do someting
+        with metrics.timer('infer', sum(image.shape[0] * image.shape[1] for image in uint8_rgb_ins)):
+            uin8_outs = iter(call_batch(func, uint8_rgb_ins, valid_masks) if to_infer else [])
+
+        for b, uint8_rgb_in, orig_size, valid_mask in batch:
+            if uint8_rgb_in is None:
+                yield b, np.zeros((b['height'], b['width']), dtype=np.uint8)
+                continue
+
+            uin8_out = next(uin8_outs)
+            if resize_hw is not None:
+                uin8_out = cv2.resize(uin8_out, orig_size, interpolation=cv2.INTER_NEAREST)
+            if valid_mask is not None:
+                uin8_out = uin8_out * valid_mask
+            yield b, uin8_out
+
+
+def process_sample_grid(sample_grid, read, write, func,
+                        data_to_rgb=chw_to_hwc,
+                        sample_resize=None,
+                        batch_size=1,
+                        prefetch=0,
+                        read_valid=None):
+    # read(b) -> CHW block, write(b, hw_output); with prefetch > 0 reading,
+    # inference and writing run on their own threads linked by bounded queues
+    blocks = read_stage(sample_grid, read, data_to_rgb, sample_resize, read_valid)
+    run_pipeline(blocks, write, func, sample_resize, batch_size, prefetch, total=len(sample_grid))
+
+
+def run_pipeline(blocks, write, func, resize_hw=None, batch_size=1, prefetch=0, total=None):
+    # blocks are read_stage items, the inference and write stages of process_sample_grid
+    if prefetch > 0:
+        blocks = threaded(blocks, prefetch)
+
+    outputs = infer_stage(blocks, func, resize_hw, batch_size)
+    if prefetch > 0:
+        outputs = threaded(outputs, prefetch)
+
+    try:
+        for b, uin8_out in tqdm(outputs, total=total):
+            with metrics.timer('write', b['height'] * b['width']):
+                write(b, uin8_out)
+    finally:
+        outputs.close()
+
+
+def split_cores(workers):
+    # Contiguous core ranges, so a worker tends to stay on one socket
+    cores = sorted(os.sched_getaffinity(0))
+    per_worker = max(1, len(cores) // workers)
+    return [cores[i * per_worker:(i + 1) * per_worker] or [cores[i % len(cores)]]
+            for i in range(workers)]
+
+
+def pool_worker(src_fp, func, cores, tasks, results,
+                data_to_rgb=chw_to_hwc,
+                sample_resize=None,
+                batch_size=1,
+                skip_invalid=False,
+                aligned_reads=True,
+                window_height=768):
+    try:
+        if cores is not None:
+            os.sched_setaffinity(0, cores)
+            torch.set_num_threads(len(cores))
+
+        with open_source(src_fp) as src:
+            # Tasks are blocks with their grid index, None tells the worker to stop
+            read, read_valid = block_readers(src, skip_invalid, aligned_reads, window_height)
+            blocks = read_stage(iter(tasks.get, None), read, data_to_rgb, sample_resize, read_valid)
+            for b, uin8_out in infer_stage(blocks, func, sample_resize, batch_size):
+                results.put((b['index'], uin8_out))
+    except BaseException:
+        results.put((None, traceback.format_exc()))
+
+
+def process_sample_grid_pool(src_fp, sample_grid, write, func,
+                             workers=2,
+                             pin_cores=True,
+                             start_method='fork',
+                             data_to_rgb=chw_to_hwc,
+                             sample_resize=None,
+                             batch_size=1,
+                             skip_invalid=False,
+                             aligned_reads=True):
+    # With 'fork' workers inherit the already loaded model copy-on-write; other
+    # start methods get it through torch shared memory
+    ctx = torch.multiprocessing.get_context(start_method)
+    if start_method != 'fork' and hasattr(func, 'share_memory'):
+        func.share_memory()
+
+    tasks = ctx.Queue()
+    results = ctx.Queue()
+    for idx, b in enumerate(sample_grid):
+        tasks.put(dict(b, index=idx))
+    for _ in range(workers):
+        tasks.put(None)
+
+    worker_cores = split_cores(workers) if pin_cores else [None] * workers
+    processes = [ctx.Process(target=pool_worker,
+                             args=(src_fp, func, cores, tasks, results,
+                                   data_to_rgb, sample_resize, batch_size, skip_invalid,
+                                   aligned_reads, sample_grid[0]['height'] if sample_grid else 0),
+                             daemon=True)
+                 for cores in worker_cores]
+    for p in processes:
+        p.start()
+
+    # The calling process is the single writer, blocks are written in grid order
+    try:
+        pending = {}
+        next_idx = 0
+        with tqdm(total=len(sample_grid)) as pbar:
+            while next_idx < len(sample_grid):
+                try:
+                    idx, uin8_out = results.get(timeout=1)
+                except queue.Empty:
+                    if any(p.exitcode not in (None, 0) for p in processes):
+                        raise RuntimeError('Sliding window worker died unexpectedly')
+                    continue
+                if idx is None:
+                    raise RuntimeError(f'Sliding window worker failed:\n{uin8_out}')
+
+                pending[idx] = uin8_out
+                while next_idx in pending:
+                    b = sample_grid[next_idx]
+                    with metrics.timer('write', b['height'] * b['width']):
+                        write(b, pending.pop(next_idx))
+                    next_idx += 1
+                    pbar.update(1)
+    finally:
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+
+
+def run_sample_grid(src, sample_grid, write, func,
+                    data_to_rgb=chw_to_hwc,
+                    sample_resize=None,
+                    batch_size=1,
+                    prefetch=0,
+                    workers=None,
+                    pin_cores=True,
+                    start_method='fork',
+                    skip_invalid=False,
+                    aligned_reads=True):
+    # Runs func over the sample grid of an open source, in process or in a worker pool
+    window_height = sample_grid[0]['height'] if sample_grid else 0
+    if workers is not None and workers > 1:
+        process_sample_grid_pool(src.name, sample_grid, write, func,
+                                 workers=workers,
+                                 pin_cores=pin_cores,
+                                 start_method=start_method,
+                                 data_to_rgb=data_to_rgb,
+                                 sample_resize=sample_resize,
+                                 batch_size=batch_size,
+                                 skip_invalid=skip_invalid,
+                                 aligned_reads=aligned_reads)
+    else:
+        read, read_valid = block_readers(src, skip_invalid, aligned_reads, window_height)
+        process_sample_grid(sample_grid,
+                            read=read,
+                            write=write,
+                            func=func,
+                            data_to_rgb=data_to_rgb,
+                            sample_resize=sample_resize,
+                            batch_size=batch_size,
+                            prefetch=prefetch,
+                            read_valid=read_valid)
+
+
+def scratch_memmap(shape, dtype=np.uint8, dir=None):
+    # Backed by an already unlinked temporary file, disk space is freed with the array
+    with tempfile.NamedTemporaryFile(dir=dir) as tmpfile:
+        return np.memmap(tmpfile, dtype=dtype, mode='w+', shape=shape)
+
+
 def tiff_to_tiff(src_fp, dst_fp, func,
                  data_to_rgb=chw_to_hwc,
                  sample_size=(512, 512),
                  sample_resize=None,
-                 bound=128):
+                 bound=128,
+                 resume=False,
+                 checkpoint_every=64,
+                 aligned_reads=True,
+                 stitch=False,
+                 stitch_threshold=0.5,
+                 cog=False,
+                 block_size=512,
+                 num_threads='ALL_CPUS',
+                 aoi=None,
+                 aoi_crs=None,
+                 dst_crs=None,
+                 resolution=None,
+                 resampling='bilinear',
+                 **kwargs):
+    # With stitch=True func returns instance labels per tile, instances cut by
+    # tile seams get one id and the output holds int32 instance ids.
+    # With cog=True the output is a Cloud Optimized GeoTIFF with overviews.
+    # aoi (vector file path or shapely geometry in aoi_crs, the raster CRS by
+    # default) restricts processing to the blocks it touches and clips the output.
+    # src_fp can be a list of GeoTIFFs, read as one mosaic without merging.
+    # dst_crs and resolution (GSD in dst_crs units) define the output grid, sample
+    # windows are warped to it on the fly, so tiles are seen by the model at one
+    # GSD whatever the sources are (sample_resize is not needed then)
+    if stitch and resume:
+        raise ValueError('stitch=True can not be combined with resume=True')
+    if cog and resume:
+        raise ValueError('cog=True can not be combined with resume=True')
 
-    with rasterio.open(src_fp) as src:
+    with open_source(src_fp, dst_crs, resolution, resampling) as src:
         profile = src.profile
         
         # Computer blocks
@@ -75,62 +643,214 @@ def tiff_to_tiff(src_fp, dst_fp, func,
         resize_hw = sample_resize
         
         sample_grid = calculate_sample_grid(raster_h=rh, raster_w=rw, sample_h=sh, sample_w=sw, bound=bound)
+        clipper = None
+        if aoi is not None:
+            aoi_px = to_pixels(load_aoi(aoi, src.crs, aoi_crs), src.transform)
+            sample_grid = prune_sample_grid(sample_grid, aoi_px)
+            clipper = AoiClipper(aoi_px)
+        if aligned_reads:
+            sample_grid = order_sample_grid(sample_grid, *src.block_shapes[0])
         # set 1 channel uint8 output
         profile['count'] = 1
-        profile['dtype'] = 'uint8'
-
-        with rasterio.open(dst_fp, 'w', **profile) as dst:
-            for b in tqdm(sample_grid):
-                r = read_block(src, **b)
-                
-                uint8_rgb_in = data_to_rgb(r)
-                orig_size = uint8_rgb_in.shape[:2]
-                if resize_hw is not None:
-                    uint8_rgb_in = cv2.resize(uint8_rgb_in, resize_hw, interpolation=cv2.INTER_LINEAR)
-                
-                # Do someting
-                uin8_out = func(uint8_rgb_in)
-
-                if resize_hw is not None:
-                    uin8_out = cv2.resize(uin8_out, orig_size, interpolation=cv2.INTER_NEAREST)
-                # Zero chennel, becouse 
-                write_block(dst, uin8_out, **b)
+        profile['dtype'] = 'int32' if stitch else 'uint8'
+
+        # Resumable jobs keep a journal of written blocks next to the output
+        journal = None
+        update = False
+        journal_fp = dst_fp + '.journal'
+        if not resume and os.path.exists(journal_fp):
+            # dst_fp is written anew, the journal of an earlier run does not describe it
+            os.remove(journal_fp)
+        if resume:
+            if not os.path.exists(dst_fp) and os.path.exists(journal_fp):
+                os.remove(journal_fp)
+            grid_params = {'height': rh, 'width': rw, 'sample_size': [sh, sw], 'bound': bound,
+                           'sample_resize': resize_hw}
+            if clipper is not None:
+                grid_params['aoi'] = clipper.geometry.wkt
+            if dst_crs is not None or resolution is not None:
+                grid_params['crs'] = src.crs.to_string()
+                grid_params['resolution'] = list(src.res)
+            journal = JobJournal(journal_fp, grid_params)
+            completed = journal.completed()
+            update = len(completed) > 0
+            sample_grid = sample_grid.take(np.array([(int(y), int(x)) not in completed
+                                                     for y, x in sample_grid.origins], dtype=bool))
+
+        # Resumed jobs update the output in place block by block, other jobs
+        # buffer bands of output tiles. A COG is made from a tiled scratch file
+        out_fp = dst_fp + '.part.tif' if cog else dst_fp
+        if resume:
+            writer = BlockWriter(dst_fp, profile, journal, checkpoint_every, update)
+        else:
+            writer = BufferedBlockWriter(out_fp, profile, block_size, num_threads, sample_grid)
+
+        stitcher = InstanceStitcher(sample_size, stitch_threshold, sample_grid.origins) if stitch else None
+        with writer:
+            write = stitcher.wrap(writer.write) if stitch else writer.write
+            if clipper is not None:
+                write = clipper.wrap(write)
+            run_sample_grid(src, sample_grid, write, func,
+                            data_to_rgb=data_to_rgb,
+                            sample_resize=resize_hw,
+                            aligned_reads=aligned_reads,
+                            **kwargs)
+
+    if stitch:
+        relabel_raster(out_fp, stitcher.ids.lookup())
+    if cog:
+        write_cog(out_fp, dst_fp, block_size, num_threads)
+        os.remove(out_fp)
+
+
+def tiffs_to_tiffs(jobs, func,
+                   data_to_rgb=chw_to_hwc,
+                   sample_size=(512, 512),
+                   sample_resize=None,
+                   bound=128,
+                   batch_size=1,
+                   prefetch=2,
+                   skip_invalid=False,
+                   aligned_reads=True,
+                   block_size=512,
+                   num_threads='ALL_CPUS',
+                   on_scene_done=None):
+    # jobs are (src_fp, dst_fp) pairs. The blocks of all scenes go through one
+    # read -> infer -> write pipeline, so the next scene is read (and batched)
+    # while the tail of the previous one is inferred and the model does not
+    # wait between files. on_scene_done(src_fp, dst_fp) runs on a background
+    # thread once a scene output is complete. Outputs are written to
+    # dst_fp + '.part.tif' and renamed when complete, so an interrupted run
+    # leaves no dst_fp that looks finished
+    sh, sw = sample_size
+
+    def scene_blocks():
+        for src_fp, dst_fp in jobs:
+            with open_source(src_fp) as src:
+                profile = src.profile
+                profile['count'] = 1
+                profile['dtype'] = 'uint8'
+
+                sample_grid = calculate_sample_grid(raster_h=src.height, raster_w=src.width,
+                                                    sample_h=sh, sample_w=sw, bound=bound)
+                if aligned_reads:
+                    sample_grid = order_sample_grid(sample_grid, *src.block_shapes[0])
+                scene = {'src_fp': src_fp, 'dst_fp': dst_fp, 'profile': profile,
+                         'remaining': len(sample_grid), 'writer': None}
+
+                read, read_valid = block_readers(src, skip_invalid, aligned_reads, sample_grid[0]['height'])
+                for b, uint8_rgb_in, orig_size, valid_mask in read_stage(sample_grid, read, data_to_rgb,
+                                                                         sample_resize, read_valid):
+                    yield dict(b, scene=scene), uint8_rgb_in, orig_size, valid_mask
+
+    def write(b, uin8_out):
+        b = dict(b)
+        scene = b.pop('scene')
+        if scene['writer'] is None:
+            scene['writer'] = BufferedBlockWriter(scene['dst_fp'] + '.part.tif', scene['profile'],
+                                                  block_size, num_threads)
+            open_scenes.append(scene)
+        scene['writer'].write(b, uin8_out)
+
+        scene['remaining'] -= 1
+        if scene['remaining'] == 0:
+            scene['writer'].close()
+            open_scenes.remove(scene)
+            os.replace(scene['dst_fp'] + '.part.tif', scene['dst_fp'])
+            if on_scene_done is not None:
+                done.append(executor.submit(on_scene_done, scene['src_fp'], scene['dst_fp']))
+
+    open_scenes = []
+    done = []
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        try:
+            run_pipeline(scene_blocks(), write, func, sample_resize, batch_size, prefetch)
+        finally:
+            # Unfinished outputs are removed
+            for scene in open_scenes:
+                scene['writer'].close()
+                os.remove(scene['dst_fp'] + '.part.tif')
+    # Raises errors of the background tasks
+    for future in done:
+        future.result()
 
 
 def image_to_image(image, func,
                    sample_size=(384, 384),
                    sample_resize=None,
-                   bound=128):
-    
-    with tempfile.NamedTemporaryFile() as src_tmpfile:
-        s, b = cv2.imencode('.tif', image)
-        src_tmpfile.write(b.tobytes())
-        src_fp = src_tmpfile.name
-        with tempfile.NamedTemporaryFile() as dst_tmpfile:
-            dst_fp = dst_tmpfile.name
-            tiff_to_tiff(src_fp, dst_fp, func,
-                 data_to_rgb=chw_to_hwc,
-                 sample_size=sample_size,
-                 sample_resize=sample_resize,
-                 bound=bound)
-            
-            result = cv2.imread(dst_fp)
-    return result[..., 0]
+                   bound=128,
+                   memmap=False,
+                   memmap_dir=None,
+                   **kwargs):
+    # Image is HWC in OpenCV channel order (BGR / BGRA), like the TIFF round trip
+    # through cv2.imencode this function used before, func gets RGB
+    if image.ndim == 2:
+        image = image[..., None]
+    elif image.shape[2] == 3:
+        image = image[..., ::-1]
+    elif image.shape[2] > 3:
+        image = np.concatenate([image[..., 2::-1], image[..., 3:]], axis=2)
+    chw = np.transpose(image, (2, 0, 1))
+
+    rh, rw = chw.shape[1:]
+    sh, sw = sample_size
+    sample_grid = calculate_sample_grid(raster_h=rh, raster_w=rw, sample_h=sh, sample_w=sw, bound=bound)
+
+    # With memmap=True the result lives in a scratch file instead of RAM
+    if memmap:
+        result = scratch_memmap((rh, rw), dir=memmap_dir)
+    else:
+        result = np.zeros((rh, rw), dtype=np.uint8)
+    process_sample_grid(sample_grid,
+                        read=lambda b: read_array_block(chw, **b),
+                        write=lambda b, uin8_out: write_array_block(result, uin8_out, **b),
+                        func=func,
+                        data_to_rgb=chw_to_hwc,
+                        sample_resize=sample_resize,
+                        **kwargs)
+    return result
 
 
 def tiff_to_image(src_fp, func,
                   data_to_rgb=chw_to_hwc,
                   sample_size=(512, 512),
                   sample_resize=None,
-                  bound=128):
-    
-    with tempfile.NamedTemporaryFile() as dst_tmpfile:
-        dst_fp = dst_tmpfile.name
-        tiff_to_tiff(src_fp, dst_fp, func,
-                data_to_rgb=data_to_rgb,
-                sample_size=sample_size,
-                sample_resize=sample_resize,
-                bound=bound)
-        
-        result = cv2.imread(dst_fp)
-    return result[..., 0]
\ No newline at end of file
+                  bound=128,
+                  memmap=False,
+                  memmap_dir=None,
+                  aligned_reads=True,
+                  stitch=False,
+                  stitch_threshold=0.5,
+                  dst_crs=None,
+                  resolution=None,
+                  resampling='bilinear',
+                  **kwargs):
+
+    with open_source(src_fp, dst_crs, resolution, resampling) as src:
+        rh, rw = src.height, src.width
+        sh, sw = sample_size
+        sample_grid = calculate_sample_grid(raster_h=rh, raster_w=rw, sample_h=sh, sample_w=sw, bound=bound)
+        if aligned_reads:
+            sample_grid = order_sample_grid(sample_grid, *src.block_shapes[0])
+
+        # Written straight into the result, with memmap=True it lives in a
+        # scratch file and can be sliced without loading the whole raster
+        dtype = np.int32 if stitch else np.uint8
+        if memmap:
+            result = scratch_memmap((rh, rw), dtype=dtype, dir=memmap_dir)
+        else:
+            result = np.zeros((rh, rw), dtype=dtype)
+
+        write = lambda b, uin8_out: write_array_block(result, uin8_out, **b)
+        stitcher = InstanceStitcher(sample_size, stitch_threshold, sample_grid.origins) if stitch else None
+        run_sample_grid(src, sample_grid,
+                        stitcher.wrap(write) if stitch else write,
+                        func,
+                        data_to_rgb=data_to_rgb,
+                        sample_resize=sample_resize,
+                        aligned_reads=aligned_reads,
+                        **kwargs)
+
+    if stitch:
+        relabel_array(result, stitcher.ids.lookup())
+    return result
@@ -0,0 +1,117 @@
+import os
+
+import numpy as np
+import rasterio
+
+
+class UnionFind:
+
+    def __init__(self):
+        # Id 0 is the background
+        self.parent = [0]
+
+    def add(self, n):
+        # Adds n new ids and returns the first one
+        start = len(self.parent)
+        self.parent.extend(range(start, start + n))
+        return start
+
+    def find(self, i):
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            self.parent[max(ra, rb)] = min(ra, rb)
+
+    def lookup(self):
+        # Provisional id -> final id, final ids are compact and 0 stays background
+        roots = np.array([self.find(i) for i in range(len(self.parent))], dtype=np.int64)
+        _, final = np.unique(roots, return_inverse=True)
+        return final.astype(np.int32)
+
+
+class InstanceStitcher:
+    # Gives instances of neighbouring tiles one id when they overlap along the
+    # strip both tiles have seen (2 * bound wide, or the touching pixel columns
+    # and rows when bound is 0). Tiles must come left to right and top to bottom.
+    # origins are the (y, x) of all tiles to come (e.g. SampleGrid.origins),
+    # strips no tile can take (the last column and row, next to pruned tiles)
+    # are then not kept
+
+    def __init__(self, sample_size, threshold=0.5, origins=None):
+        self.step_h, self.step_w = sample_size
+        self.threshold = threshold
+        self.origins = None if origins is None else set(map(tuple, np.asarray(origins).tolist()))
+        self.ids = UnionFind()
+        self.right_strips = {}
+        self.bottom_strips = {}
+
+    def stitch(self, b, labels):
+        # Tile labels -> provisional global ids
+        labels = labels.astype(np.int32)
+        offset = self.ids.add(int(labels.max())) - 1
+        labels = np.where(labels > 0, labels + offset, 0)
+
+        y, x = b['y'], b['x']
+        overlap_h = max(b['height'] - self.step_h, 1)
+        overlap_w = max(b['width'] - self.step_w, 1)
+
+        left = self.right_strips.pop((y, x - self.step_w), None)
+        if left is not None:
+            self.match(left, labels[:, :overlap_w])
+        top = self.bottom_strips.pop((y - self.step_h, x), None)
+        if top is not None:
+            self.match(top, labels[:overlap_h, :])
+
+        if self.has_tile(y, x + self.step_w):
+            self.right_strips[(y, x)] = labels[:, -overlap_w:].copy()
+        if self.has_tile(y + self.step_h, x):
+            self.bottom_strips[(y, x)] = labels[-overlap_h:, :].copy()
+        return labels
+
+    def has_tile(self, y, x):
+        return self.origins is None or (y, x) in self.origins
+
+    def match(self, labels_a, labels_b):
+        both = (labels_a > 0) & (labels_b > 0)
+        if not both.any():
+            return
+
+        # Pixels shared by every pair of instances, and instance areas in the strip
+        pairs, shared = np.unique((labels_a[both].astype(np.int64) << 32) | labels_b[both],
+                                  return_counts=True)
+        ids_a, areas_a = np.unique(labels_a[labels_a > 0], return_counts=True)
+        ids_b, areas_b = np.unique(labels_b[labels_b > 0], return_counts=True)
+        pair_a, pair_b = pairs >> 32, pairs & 0xFFFFFFFF
+        smaller_area = np.minimum(areas_a[np.searchsorted(ids_a, pair_a)],
+                                  areas_b[np.searchsorted(ids_b, pair_b)])
+
+        # Same instance if it covers most of the smaller of the two parts
+        same = shared >= self.threshold * smaller_area
+        for a, b in zip(pair_a[same], pair_b[same]):
+            self.ids.union(int(a), int(b))
+
+    def wrap(self, write):
+        return lambda b, labels: write(b, self.stitch(b, labels))
+
+
+def relabel_array(array, lookup, rows=1024):
+    # In place and by rows, so memmaps are not loaded at once
+    for i in range(0, array.shape[0], rows):
+        array[i:i + rows] = lookup[array[i:i + rows]]
+
+
+def relabel_raster(fp, lookup):
+    # Rewritten into a new file, updating compressed blocks in place would grow the file
+    tmp_fp = fp + '.stitch.tif'
+    with rasterio.open(fp) as src:
+        with rasterio.open(tmp_fp, 'w', **src.profile) as dst:
+            for _, window in src.block_windows(1):
+                dst.write(lookup[src.read(1, window=window)], 1, window=window)
+    os.replace(tmp_fp, fp)
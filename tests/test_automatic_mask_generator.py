@@ -0,0 +1,95 @@
+import cv2
+import numpy as np
+import pytest
+import torch
+
+from segment_anything import SamAutomaticMaskGenerator
+from segment_anything.build_sam import _build_sam
+
+POINTS_PER_SIDE = 4
+POINTS_PER_BATCH = 8
+SIZE = (128, 128)
+
+
+@pytest.fixture(scope="module")
+def sam():
+    # Randomly initialised tiny encoder, the mask decoder has the full size
+    torch.manual_seed(0)
+    return _build_sam(
+        encoder_embed_dim=32,
+        encoder_depth=2,
+        encoder_num_heads=2,
+        encoder_global_attn_indexes=[1],
+    )
+
+
+@pytest.fixture(scope="module")
+def image():
+    rng = np.random.default_rng(0)
+    return cv2.GaussianBlur((rng.random(SIZE + (3,)) * 255).astype(np.uint8), (15, 15), 5)
+
+
+@pytest.fixture(scope="module")
+def empty_first_batch(sam, image):
+    # A point grid whose first prompt batch has no mask over the returned
+    # pred_iou_thresh, while the last batch has some
+    generator = SamAutomaticMaskGenerator(sam, points_per_side=POINTS_PER_SIDE)
+    predictor = generator.predictor
+    predictor.set_image(image)
+    grid = generator.point_grids[0] * np.array(SIZE[::-1])[None]
+    batches = [grid[i : i + POINTS_PER_BATCH] for i in range(0, len(grid), POINTS_PER_BATCH)]
+    best = []
+    for points in batches:
+        in_points = torch.as_tensor(predictor.transform.apply_coords(points, SIZE))
+        in_labels = torch.ones(len(in_points), dtype=torch.int)
+        _, iou_preds, _ = predictor.predict_torch(
+            in_points[:, None, :], in_labels[:, None], multimask_output=True
+        )
+        best.append(float(iou_preds.max()))
+    order = np.argsort(best)
+    assert best[order[0]] < best[order[-1]]
+    point_grid = np.concatenate([batches[i] for i in order]) / np.array(SIZE[::-1])[None]
+    return point_grid, (best[order[0]] + best[order[-1]]) / 2
+
+
+def num_masks(result, output_mode):
+    return len(result["area"]) if output_mode == "label_map" else len(result)
+
+
+@pytest.mark.parametrize("low_res_filtering", [False, True])
+@pytest.mark.parametrize("output_mode", ["binary_mask", "label_map"])
+def test_image_without_masks(sam, image, output_mode, low_res_filtering):
+    generator = SamAutomaticMaskGenerator(
+        sam,
+        points_per_side=POINTS_PER_SIDE,
+        stability_score_thresh=1.01,
+        output_mode=output_mode,
+        low_res_filtering=low_res_filtering,
+    )
+    result = generator.generate(image)
+    assert num_masks(result, output_mode) == 0
+    if output_mode == "label_map":
+        assert result["segmentation"].shape == SIZE
+        assert not result["segmentation"].any()
+        assert result["bbox"].shape == (0, 4)
+        assert result["crop_box"].shape == (0, 4)
+
+
+@pytest.mark.parametrize("low_res_filtering", [False, True])
+@pytest.mark.parametrize("output_mode", ["binary_mask", "label_map"])
+def test_batch_without_masks_before_batch_with_masks(
+    sam, image, empty_first_batch, output_mode, low_res_filtering
+):
+    point_grid, pred_iou_thresh = empty_first_batch
+    generator = SamAutomaticMaskGenerator(
+        sam,
+        points_per_side=None,
+        point_grids=[point_grid],
+        points_per_batch=POINTS_PER_BATCH,
+        pred_iou_thresh=pred_iou_thresh,
+        stability_score_thresh=0.0,
+        output_mode=output_mode,
+        low_res_filtering=low_res_filtering,
+    )
+    result = generator.generate(image)
+    assert num_masks(result, output_mode) > 0
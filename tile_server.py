@@ -0,0 +1,226 @@
+import argparse
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+import rasterio.warp
+from rasterio.enums import Resampling
+from rasterio.errors import WindowError
+from rasterio.transform import from_bounds
+from rasterio.windows import Window, from_bounds as window_from_bounds
+
+
+# Half of the EPSG:3857 world width in meters
+WEB_MERCATOR_ORIGIN = 20037508.342789244
+TILE_PATH = re.compile(r'^/(\d+)/(\d+)/(\d+)\.png$')
+
+
+def tile_bounds(z, x, y):
+    # EPSG:3857 (left, bottom, right, top) of an XYZ tile
+    size = 2 * WEB_MERCATOR_ORIGIN / 2 ** z
+    left = -WEB_MERCATOR_ORIGIN + x * size
+    top = WEB_MERCATOR_ORIGIN - y * size
+    return left, top - size, left + size, top
+
+
+class TileCache:
+    # PNG tiles on disk as cache_dir/z/x/y.png, least recently used tiles are
+    # removed when the cache grows over max_bytes
+
+    def __init__(self, cache_dir, max_bytes=512 * 2 ** 20):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        # Tiles of previous runs, oldest first
+        self.sizes = OrderedDict()
+        found = []
+        for root, _, files in os.walk(cache_dir):
+            for name in files:
+                if name.endswith('.png'):
+                    fp = os.path.join(root, name)
+                    stat = os.stat(fp)
+                    found.append((stat.st_mtime, fp, stat.st_size))
+        for _, fp, size in sorted(found):
+            self.sizes[fp] = size
+        self.total = sum(self.sizes.values())
+
+    def path(self, z, x, y):
+        return os.path.join(self.cache_dir, str(z), str(x), f'{y}.png')
+
+    def get(self, z, x, y):
+        fp = self.path(z, x, y)
+        with self.lock:
+            if fp not in self.sizes:
+                return None
+            self.sizes.move_to_end(fp)
+        try:
+            with open(fp, 'rb') as f:
+                data = f.read()
+            # mtime keeps the recency for the next run
+            os.utime(fp)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def put(self, z, x, y, data):
+        fp = self.path(z, x, y)
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+        tmp_fp = f'{fp}.{threading.get_ident()}.tmp'
+        with open(tmp_fp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_fp, fp)
+
+        with self.lock:
+            self.total += len(data) - self.sizes.pop(fp, 0)
+            self.sizes[fp] = len(data)
+            while self.total > self.max_bytes and len(self.sizes) > 1:
+                old_fp, size = self.sizes.popitem(last=False)
+                self.total -= size
+                try:
+                    os.remove(old_fp)
+                except FileNotFoundError:
+                    pass
+
+
+class SegmentationTiles:
+    # Renders XYZ PNG tiles of a LazySegmentationRaster. Concurrent requests of
+    # one tile wait for a single rendering, neighbouring tiles share the sample
+    # blocks cached by the raster. Tiles needing a source window larger than
+    # max_window_side return None, so low zooms do not segment whole scenes
+
+    def __init__(self, raster, cache_dir, max_cache_bytes=512 * 2 ** 20,
+                 tile_size=256, color=(255, 255, 0), max_window_side=4096):
+        self.raster = raster
+        self.cache = TileCache(cache_dir, max_cache_bytes)
+        self.tile_size = tile_size
+        self.color = color
+        self.max_window_side = max_window_side
+        self.lock = threading.Lock()
+        self.rendering = {}
+
+    def tile(self, z, x, y):
+        data = self.cache.get(z, x, y)
+        if data is not None:
+            return data
+
+        key = (z, x, y)
+        with self.lock:
+            future = self.rendering.get(key)
+            owner = future is None
+            if owner:
+                future = self.rendering[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            data = self.render(z, x, y)
+            if data is not None:
+                self.cache.put(z, x, y, data)
+            future.set_result(data)
+            return data
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.rendering[key]
+
+    def render(self, z, x, y):
+        raster, ts = self.raster, self.tile_size
+        bounds = tile_bounds(z, x, y)
+        mask = np.zeros((ts, ts), dtype=np.uint8)
+
+        # Source window of the tile, with a pixel of margin for resampling
+        src_bounds = rasterio.warp.transform_bounds('EPSG:3857', raster.crs, *bounds)
+        window = window_from_bounds(*src_bounds, transform=raster.transform)
+        window = Window(window.col_off - 1, window.row_off - 1, window.width + 2, window.height + 2)
+        window = window.round_offsets().round_lengths()
+        try:
+            inside = window.intersection(Window(0, 0, raster.width, raster.height))
+        except WindowError:
+            inside = None
+
+        if inside is not None:
+            if max(inside.width, inside.height) > self.max_window_side:
+                return None
+            rasterio.warp.reproject(source=raster.read(inside),
+                                    destination=mask,
+                                    src_transform=raster.window_transform(inside),
+                                    src_crs=raster.crs,
+                                    dst_transform=from_bounds(*bounds, ts, ts),
+                                    dst_crs='EPSG:3857',
+                                    resampling=Resampling.nearest)
+
+        # Segments in color, the rest transparent (BGRA for OpenCV)
+        rgba = np.zeros((ts, ts, 4), dtype=np.uint8)
+        rgba[mask > 0] = (*self.color[::-1], 255)
+        return cv2.imencode('.png', rgba)[1].tobytes()
+
+
+def make_handler(tiles):
+
+    class TileHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            match = TILE_PATH.match(self.path.split('?')[0])
+            data = tiles.tile(*map(int, match.groups())) if match else None
+            if data is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(data)
+
+    return TileHandler
+
+
+def serve(tiles, host='127.0.0.1', port=8000):
+    # Tiles at http://host:port/{z}/{x}/{y}.png until interrupted
+    server = ThreadingHTTPServer((host, port), make_handler(tiles))
+    print(f'Serving segmentation tiles at http://{host}:{server.server_port}/{{z}}/{{x}}/{{y}}.png')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Serve Segment Anything segmentation of a GeoTIFF as XYZ tiles')
+    parser.add_argument('source', help='GeoTIFF to segment')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--cache-dir', default=None, help='Tile cache directory, <source>.tiles by default')
+    parser.add_argument('--max-cache-mb', type=float, default=512)
+    parser.add_argument('--checkpoint', default='sam_vit_h_4b8939.pth')
+    parser.add_argument('--model-type', default='vit_h')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--sam-kwargs', type=json.loads, default=None, help='JSON object of SamAutomaticMaskGenerator arguments')
+    parser.add_argument('--sample-size', type=int, nargs=2, default=(512, 512))
+    parser.add_argument('--bound', type=int, default=128)
+    args = parser.parse_args(args)
+
+    # Imported here, so argument errors do not wait for torch
+    from sameo import SamEO
+    sam_eo = SamEO(checkpoint=args.checkpoint, model_type=args.model_type,
+                   device=args.device, sam_kwargs=args.sam_kwargs)
+    sam_eo.serve_tiles(args.source, host=args.host, port=args.port,
+                       cache_dir=args.cache_dir,
+                       max_cache_bytes=int(args.max_cache_mb * 2 ** 20),
+                       sample_size=tuple(args.sample_size),
+                       bound=args.bound)
+
+
+if __name__ == '__main__':
+    main()